@@ -166,8 +166,9 @@ class BaseExporter(RuntimeDevice):
                         'poissoninput': {'f': collect_PoissonInput, 'n': True}
                       }
 
-        # loop through all the objects of network
-        for object in network.objects:
+        # loop through all the objects of network (sorted by name, to get
+        # the same order for every run of the script)
+        for object in sorted(network.objects, key=lambda obj: obj.name):
 
             # check the object is supported currently
             if not isinstance(object, self.supported_objs):
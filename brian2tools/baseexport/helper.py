@@ -2,8 +2,12 @@
 The file contains helper functions that shall be
 used for exporting standard representation format
 """
+import hashlib
+
+import numpy as np
 from brian2 import (DEFAULT_CONSTANTS, DEFAULT_FUNCTIONS,
                     DEFAULT_UNITS, Quantity, TimedArray, second)
+from brian2.units.fundamentalunits import get_dimensions
 from brian2.core.variables import Constant
 from brian2.core.functions import Function
 from brian2.utils.stringtools import get_identifiers
@@ -58,3 +62,59 @@ def _prepare_identifiers(identifiers):
                 clean_identifiers.update({key: value})
 
     return clean_identifiers
+
+
+def _update_hash(hasher, obj):
+    """
+    Helper function to feed a stable representation of a standard
+    dictionary item (dictionaries, sequences, arrays and quantities, strings
+    and other values) to ``hasher``. Arrays contribute their raw data
+    instead of their string representation.
+    """
+    if isinstance(obj, dict):
+        hasher.update(b'{')
+        for key in sorted(obj, key=repr):
+            _update_hash(hasher, key)
+            _update_hash(hasher, obj[key])
+        hasher.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(b'[')
+        for item in obj:
+            _update_hash(hasher, item)
+        hasher.update(b']')
+    elif isinstance(obj, (set, frozenset)):
+        hasher.update(b'(')
+        for item_hash in sorted(_hash_standard_dict(item) for item in obj):
+            hasher.update(item_hash.encode())
+        hasher.update(b')')
+    elif isinstance(obj, np.ndarray):
+        arr = np.asarray(obj)
+        hasher.update('array:{}{}{}'.format(arr.dtype.str, arr.shape,
+                                            repr(get_dimensions(obj))).encode())
+        if arr.dtype.hasobject:
+            for item in arr.flat:
+                _update_hash(hasher, item)
+        else:
+            hasher.update(np.ascontiguousarray(arr).data)
+    else:
+        hasher.update('{}:{!r};'.format(type(obj).__name__, obj).encode())
+
+
+def _hash_standard_dict(obj):
+    """
+    Helper function to calculate a hash of a standard dictionary (or any
+    of its items) that is stable across processes
+
+    Parameters
+    ----------
+    obj : object
+        Standard dictionary, or a part of it
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal SHA-256 digest
+    """
+    hasher = hashlib.sha256()
+    _update_hash(hasher, obj)
+    return hasher.hexdigest()
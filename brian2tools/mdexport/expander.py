@@ -3,13 +3,15 @@ Standard markdown expander class to expand Brian objects to
 markdown text using standard dictionary representation of baseexport
 """
 import datetime
-import inspect
 import re
+import sys
+from collections import defaultdict
 
 import brian2
 import numpy as np
 from brian2.equations.equations import str_to_sympy
-from brian2.units.fundamentalunits import DIMENSIONLESS, Quantity, get_dimensions
+from brian2.units.fundamentalunits import (DIMENSIONLESS, Quantity, Unit,
+                                           get_dimensions)
 from jinja2 import (
     ChoiceLoader,
     Environment,
@@ -24,12 +26,29 @@ from sympy import Derivative, symbols
 from sympy.abc import *
 from sympy.printing import latex
 
+from brian2tools.baseexport.helper import _hash_standard_dict
+
 # define variables for often used delimiters
 endll = '\n\n'
 endl = '\n'
 tab = '\t'
 
 
+def _edge_items(arr, edgeitems, hidden=True):
+    """
+    Reduce every axis of ``arr`` that would be summarized by
+    `numpy.array2string` to its leading and trailing ``edgeitems`` elements
+    (plus one element that is hidden behind the ellipsis, if ``hidden`` is
+    set)
+    """
+    for axis, length in enumerate(arr.shape):
+        if length > 2 * edgeitems:
+            indices = np.r_[0:edgeitems + int(hidden),
+                            length - edgeitems:length]
+            arr = np.take(arr, indices, axis=axis)
+    return arr
+
+
 class MdExpander():
 
     """
@@ -93,35 +112,71 @@ class MdExpander():
             author = '-'
         self.author = author
 
-        # get source file name, datetime and Brian version
-        frame = inspect.stack()[1]
-        user_file = inspect.getmodule(frame[0]).__file__
-        date_time = datetime.datetime.now()
-        brian_version = brian2.__version__
-
-        # prepare meta-data
-        meta_data = italics('Filename: {}\
-                             \nAuthor: {}\
-                             \nDate and localtime: {}\
-                             \nBrian version: {}'.format(user_file, author,
-                             date_time.strftime('%Y-%m-%d %H:%M:%S %Z'),
-                             brian_version)) + endl + horizontal_rule() + endl
-
-        self.meta_data = meta_data
-        self.user_file = user_file
+        # only keep a reference to the caller's globals, the source file
+        # name is looked up on demand (see `user_file`)
+        self._caller_globals = sys._getframe(1).f_globals
+        self.date_time = datetime.datetime.now()
         self.add_meta = add_meta
         self.github_md = github_md
+        # rendered markdown of components, indexed by hash of the component
+        # and of the expander settings (see `create_md_string`)
+        self.fragment_cache = None
+        self.fragments = {}
         self.env = Environment(
             loader=PackageLoader("brian2tools"),
             autoescape=select_autoescape()
         )
 
+    @property
+    def user_file(self):
+        """
+        Source file of the script that created the expander
+        """
+        return self._caller_globals['__file__']
+
+    @property
+    def meta_data(self):
+        """
+        Meta-data (filename, author, date and Brian version) that is added
+        to the markdown text if ``add_meta`` is set
+        """
+        return italics('Filename: {}\
+                             \nAuthor: {}\
+                             \nDate and localtime: {}\
+                             \nBrian version: {}'.format(self.user_file, self.author,
+                             self.date_time.strftime('%Y-%m-%d %H:%M:%S %Z'),
+                             brian2.__version__)) + endl + horizontal_rule() + endl
+
     def set_template_dir(self, template_dir):
         self.env = Environment(
             loader=ChoiceLoader([FileSystemLoader(template_dir), PackageLoader("brian2tools")]),
             autoescape=select_autoescape()
         )
 
+    def settings_hash(self, template_name):
+        """
+        Hash of everything apart from the run dictionary that determines the
+        markdown text, i.e. the expander class and options, the Brian
+        version and the source of all templates of the given type
+
+        Parameters
+        ----------
+
+        template_name : str
+            Name of the template type (e.g. ``'default'``)
+        """
+        templates = {}
+        for name in self.env.list_templates(
+                filter_func=lambda n: n.endswith('-{}.md'.format(template_name))):
+            templates[name] = self.env.loader.get_source(self.env, name)[0]
+        settings = {'expander': (type(self).__module__, type(self).__qualname__),
+                    'options': (self.brian_verbose, self.include_monitors,
+                                self.keep_initializer_order, self.author,
+                                self.add_meta, self.github_md),
+                    'brian_version': brian2.__version__,
+                    'templates': templates}
+        return _hash_standard_dict(settings)
+
     def check_plural(self, iterable, singular_word=None,
                      allow_constants=True, is_int=False):
         """
@@ -223,9 +278,12 @@ class MdExpander():
         # to remove ',' from last item
         return rend_str[:-2]
 
-    def prepare_array(self, arr, threshold=10, precision=2):
+    def prepare_array(self, arr, threshold=10, precision=2, edgeitems=3):
         """
-        Prepare arrays using `numpy.array2string`
+        Prepare arrays using `numpy.array2string`. For arrays with more than
+        ``threshold`` elements, only the ``edgeitems`` leading and trailing
+        elements of each axis are converted to strings, and the global
+        NumPy print options are not touched.
 
         Parameters
         ----------
@@ -239,17 +297,109 @@ class MdExpander():
         precision : int, optional
             Floating point precision
 
+        edgeitems : int, optional
+            Number of leading and trailing elements shown for summarized
+            arrays
         """
-        if not isinstance(arr, Quantity):
-            arr = np.array(arr)
-        old_threshold = np.get_printoptions()['threshold']
-        old_precision = np.get_printoptions()['precision']
-        np.set_printoptions(threshold=threshold, precision=precision)
-        md_str = str(arr)
-        # reset to old value
-        np.set_printoptions(threshold=old_threshold,precision=old_precision)
+        values = np.asarray(arr)
+        summarized = values.size > threshold
+        if summarized:
+            values = _edge_items(values, edgeitems)
+        if isinstance(arr, Quantity):
+            # like Brian, choose the unit for the values that are shown
+            shown = values
+            if summarized:
+                shown = _edge_items(values, edgeitems, hidden=False)
+            unit = Quantity(shown, dim=arr.dim).get_best_unit()
+        else:
+            unit = None
+        if summarized:
+            # the array has been reduced, but should still be summarized
+            threshold = 0
+        if unit is not None:
+            values = values / np.asarray(unit)
+        if values.ndim == 0:
+            if unit is None:
+                md_str = str(values)
+            else:
+                # same as Quantity.in_unit, that applies the precision
+                # to scalars as well
+                md_str = np.array2string(values.reshape(1),
+                                         precision=precision)[1:-1].strip()
+        else:
+            md_str = np.array2string(values, precision=precision,
+                                     threshold=threshold, edgeitems=edgeitems)
+        if unit is not None and not unit.is_dimensionless:
+            # same as Quantity.in_unit for units that are not registered
+            md_str += ' ' + str(unit if isinstance(unit, Unit) else unit.dim)
         return md_str
 
+    def expand_array(self, arr, threshold=10):
+        """
+        Markdown text for an array, using `prepare_array`. Arrays with more
+        than ``threshold`` elements are followed by their summary statistics
+        (see `summarize_array`).
+
+        Parameters
+        ----------
+
+        arr : `numpy.ndarray`
+            Numpy array (or `Quantity`) to expand
+
+        threshold : int, optional
+            Threshold value to print all members
+        """
+        md_str = self.prepare_array(arr, threshold=threshold)
+        if np.size(arr) > threshold:
+            md_str += ' ' + self.expand_summary(arr)
+        return md_str
+
+    def expand_summary(self, arr):
+        """
+        Markdown text for the summary statistics of an array, see
+        `summarize_array`.
+
+        Parameters
+        ----------
+
+        arr : `numpy.ndarray`
+            Numpy array (or `Quantity`) to summarize
+        """
+        summary = self.summarize_array(arr)
+        if not summary['size']:
+            return '(no values)'
+        return ('({size} values from {min} to {max} with mean {mean}, '
+                '{unique} unique)'.format(**summary))
+
+    def summarize_array(self, arr):
+        """
+        Summary statistics of an array, calculated without converting its
+        values to strings.
+
+        Parameters
+        ----------
+
+        arr : `numpy.ndarray`
+            Numpy array (or `Quantity`) to summarize
+
+        Returns
+        -------
+
+        summary : dict
+            Dictionary with the ``size`` of the array, its ``min``, ``max``
+            and ``mean`` value (with units for a `Quantity`) and the number
+            of ``unique`` values. Only the ``size`` is given for an empty
+            array.
+        """
+        if not isinstance(arr, Quantity):
+            arr = np.asarray(arr)
+        summary = {'size': arr.size}
+        if arr.size:
+            summary.update({'min': arr.min(), 'max': arr.max(),
+                            'mean': arr.mean(),
+                            'unique': len(np.unique(np.asarray(arr)))})
+        return summary
+
     def render_expression(self, expression, differential=False):
         """
         Function to render mathematical expression using
@@ -310,6 +460,10 @@ class MdExpander():
         required expand functions and arrange the descriptions
         """
         template_name = template_name
+        # only render components that are not in the fragment cache
+        self.fragments = {}
+        if self.fragment_cache is not None:
+            settings_hash = self.settings_hash(template_name)
         # expand network header
         overall_string = self.expand_network_header(net_dict)
 
@@ -372,6 +526,18 @@ class MdExpander():
                     "order": 0,
                 },
             }
+            if not self.keep_initializer_order:
+                # index initializers and connectors by group/synapses name
+                initializers = defaultdict(list)
+                connectors = defaultdict(list)
+                for init_cont in run_dict.get('initializers_connectors', []):
+                    if init_cont['type'] == 'initializer':
+                        # initializers of subgroups are not included
+                        if isinstance(init_cont['source'], str):
+                            initializers[init_cont['source']].append(init_cont)
+                    elif init_cont['type'] == 'connect':
+                        connectors[init_cont['synapses']].append(init_cont)
+
             # loop over each order and expand the item
             # (same complexity as sorting the dict)
             order_list = [0, 1, 2, 3, 4]
@@ -396,20 +562,25 @@ class MdExpander():
                         # point out components
                         for obj_mem in obj_list:
                             if not self.keep_initializer_order:
-                                # Add initializer/connector information to the respective dict
-                                initializers_connectors = run_dict.get('initializers_connectors', [])
+                                # Add initializer/connector information to a
+                                # copy of the respective dict
                                 if obj_key in ['neurongroup', 'synapses']:
-                                    obj_mem['initializer'] = [initializer
-                                                              for initializer in initializers_connectors
-                                                              if initializer['type'] == 'initializer' and
-                                                                 initializer['source'] == obj_mem['name']]
+                                    obj_mem = dict(obj_mem,
+                                                   initializer=initializers.get(obj_mem['name'], []))
                                 if obj_key == 'synapses':
-                                    obj_mem['connectors'] = [connector
-                                                             for connector in initializers_connectors
-                                                             if connector['type'] == 'connect' and
-                                                                connector['synapses'] == obj_mem['name']]
-                            run_string += ('- ' +
-                                           self.expand_group(obj_mem, f"{func_map[obj_key]['hb']}-{template_name}.md"))
+                                    obj_mem['connectors'] = connectors.get(obj_mem['name'], [])
+                            group_template = f"{func_map[obj_key]['hb']}-{template_name}.md"
+                            if self.fragment_cache is None:
+                                fragment = self.expand_group(obj_mem, group_template)
+                            else:
+                                fragment_hash = _hash_standard_dict([settings_hash,
+                                                                     group_template,
+                                                                     obj_mem])
+                                fragment = self.fragment_cache.get(fragment_hash)
+                                if fragment is None:
+                                    fragment = self.expand_group(obj_mem, group_template)
+                                self.fragments[fragment_hash] = fragment
+                            run_string += '- ' + fragment
 
             if self.keep_initializer_order:
                 # differentiate connectors and initializers
@@ -698,6 +869,9 @@ class MdExpander():
         else:
             init_str += '= '
         init_str += self.render_expression(initializer['value'])
+        if (not isinstance(initializer['value'], str) and
+                np.size(initializer['value']) > 10):
+            init_str += ' ' + self.expand_summary(initializer['value'])
 
         # not a good checking
         if (isinstance(initializer['index'], str) and
@@ -1,10 +1,18 @@
 from brian2.devices.device import all_devices
 from brian2tools.baseexport.device import BaseExporter
+import functools
+import hashlib
+import json
 import os
 import inspect
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from brian2tools.baseexport.helper import _hash_standard_dict
 from .expander import *
 
+FORMATS_EXTENSIONS = {'latex': '.tex', 'html': '.html', 'pdf': '.pdf'}
+HASHES_EXTENSION = '.hashes.json'
+
 
 class MdExporter(BaseExporter):
     """
@@ -83,9 +91,6 @@ class MdExporter(BaseExporter):
             self.expander.set_template_dir(template_dir)
     
 
-        # start creating markdown descriptions using expander
-        self.md_text = self.expander.create_md_string(self.runs, template_name)
-
         # check output filename
         if filename:
             if not isinstance(filename, str):
@@ -101,21 +106,36 @@ class MdExporter(BaseExporter):
 
         # check whether in debug mode to print output in stdout
         if debug:
+            # start creating markdown descriptions using expander
+            self.md_text = self.expander.create_md_string(self.runs, template_name)
             print(self.md_text)
         elif self.filename:
-            # start writing markdown text in file
             source_file = self.filename + ".md"
-            md_file = open(source_file, "w")
-            md_file.write(self.md_text)
-            md_file.close()
-            
-            # Check if Pandoc is installed
-            try:
-                subprocess.check_call(["pandoc", "--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            except FileNotFoundError:
-                raise Exception("Pandoc is not installed. Please install Pandoc and try again.")
-            
-            formats_extensions = {'latex':'.tex', 'html':'.html', 'pdf':'.pdf'}
+            cache_file = self.filename + HASHES_EXTENSION
+            cache = _read_build_cache(cache_file)
+            md_hash = _hash_standard_dict([self.expander.settings_hash(template_name),
+                                           self.runs])
+            if cache.get('markdown') == md_hash and os.path.exists(source_file):
+                # nothing changed since the previous build
+                with open(source_file) as md_file:
+                    self.md_text = md_file.read()
+                self.expander.md_text = self.md_text
+                self.expander.fragments = cache.get('fragments', {})
+            else:
+                # only re-render the components that changed
+                self.expander.fragment_cache = cache.get('fragments', {})
+                try:
+                    self.md_text = self.expander.create_md_string(self.runs,
+                                                                  template_name)
+                finally:
+                    self.expander.fragment_cache = None
+                # start writing markdown text in file
+                md_file = open(source_file, "w")
+                md_file.write(self.md_text)
+                md_file.close()
+            cache['markdown'] = md_hash
+            cache['fragments'] = self.expander.fragments
+
             if isinstance(additional_formats, str):
                 if additional_formats == "all":
                     formats = ['latex', 'html', 'pdf']
@@ -123,16 +143,97 @@ class MdExporter(BaseExporter):
                     formats = [additional_formats]
             else:
                 formats = additional_formats if additional_formats is not None else []
-            for format_name in formats:
-                filename = self.filename + formats_extensions[format_name]
+            try:
+                if formats:
+                    self._convert_formats(formats, cache.setdefault('formats', {}))
+            finally:
+                with open(cache_file, 'w') as f:
+                    json.dump(cache, f, indent=2, sort_keys=True)
+        else:
+            # start creating markdown descriptions using expander
+            self.md_text = self.expander.create_md_string(self.runs, template_name)
+
+    def _convert_formats(self, formats, format_hashes):
+        """
+        Convert the written markdown file to the given formats with pandoc.
+        The conversions are run concurrently, and a format is skipped if
+        its output file has been generated from identical markdown text
+        before.
+
+        Parameters
+        ----------
+        formats : list of str
+            Formats to convert to (``'latex'``, ``'html'`` or ``'pdf'``)
+        format_hashes : dict
+            Hashes of the markdown text used for the previous conversions,
+            will be updated with the hashes of the new conversions
+        """
+        # Check if Pandoc is installed
+        if not _pandoc_available():
+            raise Exception("Pandoc is not installed. Please install Pandoc and try again.")
+
+        md_hash = hashlib.sha256(self.md_text.encode('utf-8')).hexdigest()
+        to_convert = []
+        for format_name in formats:
+            filename = self.filename + FORMATS_EXTENSIONS[format_name]
+            if (format_hashes.get(format_name) == md_hash and
+                    os.path.exists(filename)):
+                print("Skipping conversion, file is up to date:", filename)
+            else:
+                to_convert.append((format_name, filename))
+        if not to_convert:
+            return
+
+        source_file = self.filename + ".md"
+        with ThreadPoolExecutor(max_workers=len(to_convert)) as executor:
+            futures = [executor.submit(_run_pandoc, source_file, format_name,
+                                       filename)
+                       for format_name, filename in to_convert]
+            for (format_name, filename), future in zip(to_convert, futures):
                 try:
-                    subprocess.run(["pandoc", "--from", "markdown", "--to", format_name, "-o", filename, source_file],
-                                   check=True)
-                    print("Conversion complete! Files generated:", filename) 
+                    future.result()
+                    format_hashes[format_name] = md_hash
+                    print("Conversion complete! Files generated:", filename)
                 except subprocess.CalledProcessError as ex:
+                    format_hashes.pop(format_name, None)
                     print(f"Could not generate format '{format_name}': {str(ex)}")
-        else:
-            pass  # do nothing
+
+
+@functools.lru_cache(maxsize=None)
+def _pandoc_available():
+    """
+    Check (once per process) whether pandoc can be called
+    """
+    try:
+        subprocess.check_call(["pandoc", "--version"], stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _run_pandoc(source_file, format_name, filename):
+    """
+    Convert the markdown file ``source_file`` to ``format_name`` and write
+    it to ``filename``
+    """
+    subprocess.run(["pandoc", "--from", "markdown", "--to", format_name,
+                    "-o", filename, source_file], check=True)
+
+
+def _read_build_cache(cache_file):
+    """
+    Read the hashes and rendered fragments stored by previous builds,
+    returns an empty dictionary if the file does not exist or cannot be read
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
 
 
 md_device = MdExporter()
@@ -1 +1,2 @@
 from . import lemsexport
+from .batch import batch_export
@@ -0,0 +1,156 @@
+"""
+Export of many Brian models to NeuroML2/LEMS in parallel processes.
+"""
+import os
+import runpy
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from brian2.devices.device import all_devices, get_device, reset_device
+from brian2.utils.logger import get_logger
+
+from .lemsexport import LEMSDevice, LEMS_CONSTANTS_XML, nmlcdpath, _export_runs
+
+__all__ = ['batch_export']
+
+logger = get_logger(__name__)
+
+
+class _CollectingLEMSDevice(LEMSDevice):
+    """
+    `LEMSDevice` that only collects the runs of a script, instead of
+    building the model on ``run`` or on an explicit ``device.build()``.
+    """
+
+    def build(self, *args, **kwds):
+        pass
+
+
+def _collect_runs(script):
+    """
+    Runs the Brian script *script* with the ``neuroml2`` device and
+    returns the standard dictionary representation of its runs.
+    """
+    lems_device = all_devices['neuroml2']
+    collecting_device = _CollectingLEMSDevice()
+    all_devices['neuroml2'] = collecting_device
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        all_devices['neuroml2'] = lems_device
+        if get_device() is collecting_device:
+            reset_device()
+    return collecting_device.runs
+
+
+def _export_model(name, model, filename, options):
+    """
+    Exports a single model (script or list of runs), catching all errors
+    so that a failing model does not abort the batch.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        if isinstance(model, str):
+            model = _collect_runs(model)
+        filename = _export_runs(model, filename, **options)
+    except Exception:
+        error = traceback.format_exc()
+    return {'name': name, 'filename': filename,
+            'time': time.perf_counter() - start, 'error': error}
+
+
+def _model_name(model, index):
+    """
+    Returns the name of the output file (without extension) for *model*.
+    """
+    if isinstance(model, str):
+        return os.path.splitext(os.path.basename(model))[0]
+    return 'model{}'.format(index)
+
+
+def batch_export(models, outdir, workers=None, lems_const_save=True,
+                 compress=False, columns_per_file=None):
+    """
+    Exports many models to NeuroML2/LEMS files, using a pool of worker
+    processes. Each worker process parses the NeuroML dimensions and
+    units only once for all the models it exports.
+
+    Parameters
+    ----------
+    models : list or dict
+        The models to export, either file names of Brian scripts that use
+        the ``neuroml2`` device (run in the current working directory), or
+        lists of run dictionaries (the ``runs`` attribute of a
+        `BaseExporter` device). The output files are named after the
+        scripts, or ``model<index>`` for run dictionaries. If a dict is
+        given, its keys are used as the names of the output files.
+    outdir : str
+        directory of the output files, created if it does not exist
+    workers : int, optional
+        number of worker processes, by default the number of processors.
+        With a single worker, the models are exported in the current
+        process.
+    lems_const_save : bool, optional
+        whether to save the file with the units defined as constants in
+        *outdir*, default True
+    compress : bool, optional
+        whether to write gzip-compressed output files, default False
+    columns_per_file : int, optional
+        maximum number of recorded neurons stored in a single StateMonitor
+        output file, default None (no limit)
+
+    Returns
+    -------
+    results : list of dict
+        For each model (in the order of *models*) a dictionary with the
+        keys ``'name'``, ``'filename'``, ``'time'`` (the time of the export
+        in seconds) and ``'error'`` (the traceback of a failed export, or
+        None).
+    """
+    if isinstance(models, dict):
+        items = list(models.items())
+    else:
+        items = [(_model_name(model, index), model)
+                 for index, model in enumerate(models)]
+    names = [name for name, _ in items]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError("Several models would be exported to the same "
+                         "file: {}".format(', '.join(duplicates)))
+    os.makedirs(outdir, exist_ok=True)
+    options = {'compress': compress, 'columns_per_file': columns_per_file}
+    tasks = [(name, model, os.path.join(outdir, name + '.xml'), options)
+             for name, model in items]
+
+    if workers is not None and workers <= 1:
+        results = [_export_model(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_export_model, *task)
+                       for task in tasks]
+            results = []
+            for (name, _, filename, _), future in zip(tasks, futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    # the worker process itself failed (e.g. the model
+                    # could not be sent to it)
+                    results.append({'name': name, 'filename': filename,
+                                    'time': None,
+                                    'error': traceback.format_exc()})
+
+    for result in results:
+        if result['error'] is None:
+            logger.info("Exported '{}' in {:.2f}s".format(result['name'],
+                                                          result['time']))
+        else:
+            logger.warn("Export of '{}' failed:\n{}".format(result['name'],
+                                                            result['error']))
+    # the units constants are the same for all models
+    if lems_const_save:
+        shutil.copyfile(os.path.join(nmlcdpath, LEMS_CONSTANTS_XML),
+                        os.path.join(outdir, LEMS_CONSTANTS_XML))
+    return results
@@ -1,21 +1,27 @@
 import re
 import os
+import gzip
 import shutil
+from functools import lru_cache
+
 import numpy as np
 
 import lems.api as lems
 from brian2.input.poissoninput import PoissonInput
-from brian2.units.fundamentalunits import is_dimensionless
+from brian2.units.fundamentalunits import (is_dimensionless, get_dimensions,
+                                           Quantity)
+from brian2 import units
 from brian2.units import mmetre, ms
-from brian2.utils.stringtools import get_identifiers
+from brian2.codegen.generators.numpy_generator import NumpyNodeRenderer
 from brian2.utils.logger import get_logger
 from brian2.devices.device import all_devices
 from brian2tools.baseexport.device import BaseExporter
 
 from .lemsrendering import *
 from .supporting import (read_nml_units, read_nml_dims, brian_unit_to_lems,
-                         name_to_unit, NeuroMLSimulation, NeuroMLSimpleNetwork,
-                         NeuroMLTarget, NeuroMLPoissonGenerator)
+                         name_to_unit, write_dom, NeuroMLSimulation,
+                         NeuroMLSimpleNetwork, NeuroMLTarget,
+                         NeuroMLPoissonGenerator)
 
 __all__ = []
 
@@ -30,14 +36,33 @@ UNLESS_REFRACTORY = "unless refractory"
 INDEX             = "index"    # iterator in LEMS
 BASE_CELL         = "baseCell"
 BASE_POPULATION   = "basePopulation"
+INIT              = "_init"    # suffix of properties with initial values
+PARAMETER_FILE    = "parameterFile"
+UNIT_CONST        = "const"    # suffix of constants for units
+SYNAPSE_PORT      = "in"
+SYNAPSE_DELAY     = "delay"
+BULK_PROJECTION   = "bulkProjection"
+CONNECTION_FILE   = "connectionFile"
+CONNECTIONS_CHUNK_SIZE = 1000000  # connections written at once
+UNIT_CACHE_SIZE   = 4096  # unit conversions kept in the caches
+EXPRESSION_CACHE_SIZE = 4096  # rewritten expressions kept in the cache
 
 nmlcdpath = os.path.dirname(__file__)  # path to NeuroMLCoreDimensions.xml file
 LEMS_CONSTANTS_XML = "LEMSUnitsConstants.xml"  # path to units constants
 LEMS_INPUTS = "Inputs.xml"
 nml_dims  = read_nml_dims(nmlcdpath=nmlcdpath)
 nml_units = read_nml_units(nmlcdpath=nmlcdpath)
+# LEMS dimension names indexed by Brian dimensions, for equivalent
+# dimensions the first one takes precedence
+nml_dims_index = {dim: name for name, dim in reversed(list(nml_dims.items()))}
 
 renderer = LEMSRenderer()
+# renders expressions and conditions of initializers for evaluating them
+# with numpy for each neuron
+_numpy_renderer = NumpyNodeRenderer()
+_NUMPY_FUNCTIONS = ('sin', 'cos', 'tan', 'sinh', 'cosh', 'tanh', 'exp', 'log',
+                    'log10', 'sqrt', 'ceil', 'floor', 'abs', 'sign',
+                    'arcsin', 'arccos', 'arctan', 'logical_not', 'clip')
 
 
 def _find_precision(value):
@@ -53,15 +78,14 @@ def _determine_dimension(value):
     """
     From *value* with Brian2 unit determines proper LEMS dimension.
     """
-    for dim in nml_dims:
-        if value.has_same_dimensions(nml_dims[dim]):
-            return dim
+    dim = nml_dims_index.get(get_dimensions(value))
+    if dim is not None:
+        return dim
+    if value == 1:
+        # dimensionless
+        return "none"
     else:
-        if value == 1:
-            # dimensionless
-            return "none"
-        else:
-            raise AttributeError("Dimension not recognized: {}".format(str(value.dim)))
+        raise AttributeError("Dimension not recognized: {}".format(str(value.dim)))
 
 
 def _to_lems_unit(unit):
@@ -88,13 +112,221 @@ def _equation_separator(equation):
     return lhs.strip(), rhs.strip()
 
 
-def make_lems_unit(newunit):
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def _lems_unit_definition(newunit):
     """
-    Returns from *newunit* to a lems.Unit definition.
+    Returns name, dimension and power of the LEMS unit for *newunit*.
     """
     strunit = _to_lems_unit(newunit)
     power = int(np.log10((mmetre**2).base))
     dimension = _determine_dimension(newunit)
+    return strunit, dimension, power
+
+
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def _best_unit_split(value, dim):
+    """
+    Returns the value and the name of the best unit for the scalar
+    *value* (in base units) with dimension *dim*.
+    """
+    return tuple(Quantity(value, dim=dim).in_best_unit().split(' '))
+
+
+def _initializer_source(initializer):
+    """
+    Returns the name of the group initialized by *initializer* and the
+    first and last index of the initialized neurons (None for the whole
+    group).
+    """
+    source = initializer['source']
+    if isinstance(source, dict):
+        return source['group'], (source['start'], source['stop'])
+    return source, None
+
+
+def _is_unconditional(index):
+    return index is True or (isinstance(index, str) and index == 'True')
+
+
+def _evaluate_expression(expression, N, identifiers):
+    """
+    Evaluates the string *expression* (a value or a condition) for the *N*
+    neurons of a group, with ``i`` being the index of the neuron. Raises a
+    `NotImplementedError` if it depends on anything else than the neuron
+    index, the group size, units and constant identifiers.
+    """
+    namespace = dict(vars(units))
+    namespace.update({name: getattr(np, name) for name in _NUMPY_FUNCTIONS})
+    namespace['int'] = lambda value: np.asarray(value).astype(int)
+    namespace.update(identifiers)
+    namespace.update({'i': np.arange(N), 'N': N})
+    code = _numpy_renderer.render_expr(expression)
+    try:
+        return eval(code, namespace)
+    except Exception as ex:
+        raise NotImplementedError("Cannot determine the value of '{}' for "
+                                  "each neuron: {}".format(expression, ex))
+
+
+def _per_neuron_values(initializers, N):
+    """
+    Returns the values of all variables that are initialized with arrays,
+    for a subgroup or for a subset of the *N* neurons, as arrays (in base
+    units) with a value for each neuron. Conditions and expressions are
+    evaluated for each neuron. Later *initializers* overwrite earlier ones.
+    """
+    variables = set()
+    for initializer in initializers:
+        _, subgroup = _initializer_source(initializer)
+        if (subgroup is not None or
+                not _is_unconditional(initializer['index']) or
+                (not isinstance(initializer['value'], str) and
+                 np.size(initializer['value']) > 1)):
+            variables.add(initializer['variable'])
+    values = {}
+    for initializer in initializers:
+        var = initializer['variable']
+        if var not in variables:
+            continue
+        _, subgroup = _initializer_source(initializer)
+        if subgroup is None:
+            start, size = 0, N
+        else:
+            start, size = subgroup[0], subgroup[1] - subgroup[0] + 1
+        identifiers = initializer.get('identifiers', {})
+        index = initializer['index']
+        if _is_unconditional(index):
+            index = np.arange(size)
+        elif isinstance(index, str):
+            index = np.flatnonzero(np.broadcast_to(
+                _evaluate_expression(index, size, identifiers), size))
+        value = initializer['value']
+        if isinstance(value, str):
+            value = np.broadcast_to(np.asarray(
+                _evaluate_expression(value, size, identifiers)), size)[index]
+        values.setdefault(var, np.zeros(N))[start + np.asarray(index)] = np.asarray(value)
+    return values
+
+
+_IDENTIFIER = re.compile(r'\b[A-Za-z_][A-Za-z0-9_]*\b')
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def _multiinstantiate_expression(expression):
+    """
+    Rewrites *expression* for the assignment of a property in
+    MultiInstantiate, replacing the iterator ``i`` by the LEMS index and
+    units by constants (``mV`` -> ``mVconst``) in a single pass over its
+    identifiers. Returns the rewritten expression and the names of the
+    used units.
+    """
+    units = []
+
+    def substitute(match):
+        identifier = match.group()
+        # iterator is a special case
+        if identifier == "i":
+            return INDEX
+        # here it's assumed that we don't use Netwton in neuron models
+        if identifier in name_to_unit and identifier != "N":
+            if identifier not in units:
+                units.append(identifier)
+            return identifier + UNIT_CONST
+        return identifier
+
+    return _IDENTIFIER.sub(substitute, expression), tuple(units)
+
+
+_STATEMENT = re.compile(r'^\s*(\w+)\s*([-+*/]?=)\s*(.+?)\s*$')
+
+
+def _pathway_delay(pathway, initializers):
+    """
+    Returns the delay of *pathway*, either its scalar delay or the value
+    its synapses are initialized with. Raises a `NotImplementedError` if
+    the synapses have different delays.
+    """
+    delay = pathway.get('delay', 0*ms)
+    for initializer in initializers:
+        if (initializer['source'] != pathway['name'] or
+                initializer['variable'] != 'delay'):
+            continue
+        value = initializer['value']
+        if (not _is_unconditional(initializer['index']) or
+                isinstance(value, str)):
+            raise NotImplementedError("Synapses with different delays for "
+                                      "each synapse cannot be exported.")
+        values = np.ravel(np.asarray(value))
+        if np.any(values != values[0]):
+            raise NotImplementedError("Synapses with different delays for "
+                                      "each synapse cannot be exported.")
+        delay = Quantity(values[0], dim=get_dimensions(value))
+    return delay
+
+
+def _connections(connectors, source_size, target_size,
+                 chunk_size=CONNECTIONS_CHUNK_SIZE):
+    """
+    Generates the connections created by the *connectors* of a Synapses
+    object (connecting groups of size *source_size* and *target_size*) as
+    pairs of arrays of presynaptic and postsynaptic indices, with at most
+    *chunk_size* connections at a time.
+    """
+    for connector in connectors:
+        if 'i' in connector or 'j' in connector:
+            if isinstance(connector.get('i'), str) or isinstance(connector.get('j'), str):
+                raise NotImplementedError("Connections with generator syntax "
+                                          "cannot be exported.")
+            i, j = np.broadcast_arrays(
+                np.asarray(connector.get('i', np.arange(source_size))),
+                np.asarray(connector.get('j', np.arange(target_size))))
+            i, j = i.ravel(), j.ravel()
+            for start in range(0, len(i), chunk_size):
+                yield i[start:start + chunk_size], j[start:start + chunk_size]
+            continue
+        condition = str(connector.get('condition', 'True')).replace(' ', '')
+        if (connector['probability'] != 1 or connector['n_connections'] != 1 or
+                condition not in ('True', 'i==j')):
+            raise NotImplementedError("Only Synapses connected with arrays of "
+                                      "indices, all-to-all or one-to-one can "
+                                      "be exported.")
+        if condition == 'i==j':
+            n = min(source_size, target_size)
+            for start in range(0, n, chunk_size):
+                indices = np.arange(start, min(start + chunk_size, n))
+                yield indices, indices
+        else:
+            # all-to-all, with as many presynaptic neurons per chunk as fit
+            rows = max(1, chunk_size // max(1, target_size))
+            for start in range(0, source_size, rows):
+                stop = min(start + rows, source_size)
+                yield (np.repeat(np.arange(start, stop), target_size),
+                       np.tile(np.arange(target_size), stop - start))
+
+
+def _write_connections(filename, connectors, source_size, target_size,
+                       source_start=0, target_start=0):
+    """
+    Writes the connections created by *connectors* to the file
+    *filename* (gzip-compressed for a ".gz" extension), chunk by chunk.
+    """
+    if filename.endswith(".gz"):
+        f = gzip.open(filename, "wt")
+    else:
+        f = open(filename, "w")
+    with f:
+        f.write("# i j\n")
+        for i, j in _connections(connectors, source_size, target_size):
+            f.write("".join(map("{} {}\n".format,
+                                (i + source_start).tolist(),
+                                (j + target_start).tolist())))
+
+
+def make_lems_unit(newunit):
+    """
+    Returns from *newunit* to a lems.Unit definition.
+    """
+    strunit, dimension, power = _lems_unit_definition(newunit)
     return lems.Unit(strunit, symbol=strunit, dimension=dimension, power=power)
 
 
@@ -105,7 +337,11 @@ class NMLExporter(object):
     def __init__(self):
         self._model = lems.Model()
         self._all_params_unit = {}
-        self._population = None
+        self._network = None
+        self._population_names = {}
+        self._per_neuron_values = {}
+        self._group_sizes = {}
+        self._projections = {}
         self._model_namespace = {'neuronname': None,
                                  'ct_populationname': None,
                                  'populationname': None,
@@ -148,7 +384,11 @@ class NMLExporter(object):
         """
         if is_dimensionless(value_in_unit):
             return str(value_in_unit)
-        value, unit = value_in_unit.in_best_unit().split(' ')
+        if np.ndim(value_in_unit) == 0:
+            value, unit = _best_unit_split(float(value_in_unit),
+                                           get_dimensions(value_in_unit))
+        else:
+            value, unit = value_in_unit.in_best_unit().split(' ')
         lemsunit = _to_lems_unit(unit)
         if lemsunit in nml_units:
             return "{} {}".format(value, lemsunit)
@@ -187,9 +427,8 @@ class NMLExporter(object):
         """
         Add NeuronGroup to self._model
 
-        If number of elements is 1 it adds component of that type, if
-        it's bigger, the network is created by calling:
-        `make_multiinstantiate`.
+        The population of the group's neurons is added to the network by
+        calling `make_multiinstantiate`.
 
         Parameters
         ----------
@@ -203,15 +442,23 @@ class NMLExporter(object):
         # get name of the neurongrp
         component_name = neurongrp['name']
         self._model_namespace["neuronname"] = component_name
+        self._group_sizes[component_name] = neurongrp['N']
         # add BASE_CELL component
         self._component_type = lems.ComponentType(component_name, extends=BASE_CELL)
+        # only the initializers of this neurongrp (or its subgroups) are
+        # relevant
+        initializers = [initializer for initializer in initializers
+                        if _initializer_source(initializer)[0] == component_name]
+        # values that differ between neurons but are not given by an
+        # expression for all neurons cannot be expressed in LEMS, they are
+        # stored in a separate file (see `export_to_file`)
+        per_neuron_values = _per_neuron_values(initializers, neurongrp['N'])
+        initializers = [initializer for initializer in initializers
+                        if initializer['variable'] not in per_neuron_values]
         # get identifiers attached to neurongrp and create special_properties dict
-        identifiers = []
+        identifiers = dict(neurongrp.get('identifiers', {}))
         special_properties = {}
 
-        if 'identifiers' in neurongrp:
-            identifiers = neurongrp['identifiers']
-
         for initializer in initializers:
             if 'identifiers' in initializer:
                 identifiers.update(initializer['identifiers'])
@@ -231,10 +478,8 @@ class NMLExporter(object):
         # get neurongrp equations
         equations = neurongrp['equations']
         # loop over the variables
-        initializer_vars = []
-        for initializer in initializers:
-            if initializer['source'] == neurongrp['name']:
-                initializer_vars.append(initializer['variable'])
+        initializer_values = {initializer['variable']: initializer['value']
+                              for initializer in initializers}
 
         for var in equations.keys():
 
@@ -247,10 +492,20 @@ class NMLExporter(object):
                 state_var = lems.StateVariable(var, dimension=dimension, exposure=var)
                 self._component_type.add(lems.Exposure(var, dimension=dimension))
                 dynamics.add_state_variable(state_var)
+                # per-neuron initial values are given by a property
+                if var in per_neuron_values:
+                    self._component_type.add(lems.Property(var + INIT, dimension))
+                    self._all_params_unit[var + INIT] = dimension
+                    special_properties[var + INIT] = per_neuron_values[var]
             else:
-                if var in initializer_vars and 'i' in initializer['value']:
+                if var in per_neuron_values:
+                    self._component_type.add(lems.Property(var, dimension))
+                    special_properties[var] = per_neuron_values[var]
+                    continue
+                init_value = initializer_values.get(var)
+                if isinstance(init_value, str) and 'i' in init_value:
                     self._component_type.add(lems.Property(var, dimension))
-                    special_properties[var] = initializer['value']
+                    special_properties[var] = init_value
                     continue
                 state_var = lems.StateVariable(var, dimension=dimension)
                 dynamics.add_state_variable(state_var)
@@ -261,14 +516,15 @@ class NMLExporter(object):
         for var in equations.keys():
             if var in (NOT_REFRACTORY, LAST_SPIKE):
                 continue
+            if var + INIT in special_properties:
+                onstart.add(lems.StateAssignment(var, var + INIT))
+                continue
             # check the initializer is connected to this neurongrp
-            if var not in initializer_vars:
+            if var not in initializer_values:
                 continue
             if var in special_properties:
                 continue
-            for initializer in initializers:
-                if initializer['variable'] == var and initializer['source'] == neurongrp['name']:
-                    init_value = initializer['value']
+            init_value = initializer_values[var]
             if type(init_value) != str:
                 value = brian_unit_to_lems(init_value)
             else:
@@ -329,7 +585,7 @@ class NMLExporter(object):
 
         else:
             # adding events directly to dynamics
-            for spike_flag, on_cond in self._event_builder(neurongrp['events']):
+            for spike_flag, on_cond in self._event_builder(neurongrp.get('events', {})):
                 dynamics.add_event_handler(on_cond)
             # get variables with diff eqns
             for var in neurongrp['equations']:
@@ -344,15 +600,12 @@ class NMLExporter(object):
         self._model.add_component_type(self._component_type)
         # get identifiers
         paramdict = dict()
-        for ident_name, ident_value in neurongrp['identifiers'].items():
+        for ident_name, ident_value in identifiers.items():
             paramdict[ident_name] = self._unit_lems_validator(ident_value)
-        # if more than one neuron use multiinstantiate
-        if neurongrp['N'] == 1:
-            self._model.add(lems.Component("n{}".format(index_neurongrp),
-                                           component_name, **paramdict))
-        else:
-            self.make_multiinstantiate(special_properties, component_name,
-                                       paramdict, neurongrp['N'])
+        # all groups (even of a single neuron) become populations of the
+        # network, so that they can be recorded and connected
+        self.make_multiinstantiate(special_properties, component_name,
+                                   paramdict, neurongrp['N'])
 
     def make_multiinstantiate(self, special_properties, name, parameters, N):
         """
@@ -381,6 +634,8 @@ class NMLExporter(object):
         multi_ins = lems.MultiInstantiate(component_type=name,
                                           number="N")
         param_dict = {}
+        per_neuron_values = {}
+        constants = set()
         # number of neurons
         multi_ct.add(lems.Parameter(name="N", dimension="none"))
 
@@ -389,40 +644,60 @@ class NMLExporter(object):
                 multi_ct.add(lems.Parameter(name=sp+PARAM_SUBSCRIPT, dimension=self._all_params_unit[sp]))
                 multi_ins.add(lems.Assign(property=sp, value=sp+PARAM_SUBSCRIPT))
                 param_dict[sp] = parameters[sp]
+            elif isinstance(special_properties[sp], np.ndarray):
+                # values for each neuron, stored in the parameter file
+                per_neuron_values[sp] = special_properties[sp]
             else:
-                # multi_ct.add(lems.Parameter(name=sp, dimension=self._all_params_unit[sp]))
-                # check if there are some units in equations
-                equation = special_properties[sp]
-                # add spaces around brackets to prevent mismatching
-                equation = re.sub("\(", " ( ", equation)
-                equation = re.sub("\)", " ) ", equation)
-                for i in get_identifiers(equation):
-                    # iterator is a special case
-                    if i == "i":
-                        regexp_noletter = "[^a-zA-Z0-9]"
-                        equation = re.sub("{re}i{re}".format(re=regexp_noletter),
-                                                  " {} ".format(INDEX), equation)
-                    # here it's assumed that we don't use Netwton in neuron models
-                    elif i in name_to_unit and i != "N":
-                        const_i = i+'const'
-                        multi_ct.add(lems.Constant(name=const_i, symbol=const_i,
-                                     dimension=self._all_params_unit[sp], value="1"+i))
-                        equation = re.sub(i, const_i, equation)
+                # replace the iterator and units in the equation
+                equation, units = _multiinstantiate_expression(special_properties[sp])
+                for unit in units:
+                    const_unit = unit + UNIT_CONST
+                    if const_unit not in constants:
+                        constants.add(const_unit)
+                        multi_ct.add(lems.Constant(name=const_unit, symbol=const_unit,
+                                                   dimension=_determine_dimension(name_to_unit[unit]),
+                                                   value="1"+unit))
                 multi_ins.add(lems.Assign(property=sp, value=equation))
 
+        if per_neuron_values:
+            multi_ct.add(lems.Text(name=PARAMETER_FILE,
+                                   description="file with the values of the "
+                                               "properties for each neuron"))
         structure.add(multi_ins)
         multi_ct.structure = structure
         self._model.add(multi_ct)
         param_dict = dict([(k+"_p", v) for k, v in param_dict.items()])
         param_dict["N"] = N
         self._model_namespace["populationname"] = self._model_namespace["ct_populationname"] + "pop"
-        self._model_namespace["networkname"] = self._model_namespace["ct_populationname"] + "Net"
+        self._population_names[name] = self._model_namespace["populationname"]
+        if per_neuron_values:
+            self._per_neuron_values[self._model_namespace["populationname"]] = per_neuron_values
+        # all populations are part of the network named after the first one
+        if self._model_namespace["networkname"] is None:
+            self._model_namespace["networkname"] = self._model_namespace["ct_populationname"] + "Net"
         self.add_population(self._model_namespace["networkname"],
                             self._model_namespace["populationname"],
                             self._model_namespace["ct_populationname"],
                             **param_dict)
 
-    def add_statemonitor(self, statemonitor, filename="recording", outputfile=False):
+    def _recorded_population(self, monitor, indices):
+        """
+        Returns the name of the population recorded by *monitor* and the
+        *indices* of the recorded neurons (relative to the monitored group)
+        as indices into this population.
+        """
+        source = monitor['source']
+        if isinstance(source, dict):
+            # monitor of a subgroup
+            indices = indices + source['start']
+            source = source['group']
+        if source not in self._population_names:
+            raise NotImplementedError("Cannot record from '{}', only neuron "
+                                      "groups can be recorded.".format(source))
+        return self._population_names[source], indices
+
+    def add_statemonitor(self, statemonitor, filename="recording", outputfile=False,
+                         columns_per_file=None):
         """
         Recording in LEMS simulation, makes a display and recording file
         Make sure before calling that *simulation* object is created.
@@ -436,9 +711,10 @@ class NMLExporter(object):
         outputfile : dict, optional
             flag sayinf whether to record output to file or only add
             display, default False
+        columns_per_file : int, optional
+            maximum number of recorded neurons stored in a single output
+            file, if None (the default) all neurons are stored in one file
         """
-
-        filename += '.dat'
         # get the indices of neurons that are being monitored
         indices = statemonitor['record']
         # if all are monitored else use the array
@@ -446,24 +722,47 @@ class NMLExporter(object):
             indices = np.arange(statemonitor['n_indices'])
         else:
             indices = np.asarray(indices).copy()
+        population, indices = self._recorded_population(statemonitor,
+                                                        indices.ravel())
+        indices = indices.astype(str)
         # get the variables monitored
         variables = statemonitor['variables']
         # timestep of monitoring
         dt = str(statemonitor['dt'].in_unit(ms))
         # TODO: In the docstring, asked to check the _simulation
         self._simulation.update_simulation_attribute('step', dt)
-        # adding display and outputcolumn for each recorded neuron
-        for e, var in enumerate(variables):
+        # the ids and the population part of the quantities are shared by
+        # all variables, so generate them once for all recorded neurons
+        line_ids = np.char.add('line', indices)
+        selections = np.char.add(
+            np.char.add(population + '[', indices), ']/')
+        if not columns_per_file or columns_per_file >= len(indices):
+            chunks = [slice(None)]
+        else:
+            chunks = [slice(start, start + columns_per_file)
+                      for start in range(0, len(indices), columns_per_file)]
+        # adding display and outputcolumns for each recorded variable, ids
+        # are numbered consecutively over all monitors
+        for e, var in enumerate(variables, start=len(self._simulation.displays)):
+            quantities = np.char.add(selections, var)
             self._simulation.add_display("disp{}".format(e), str(var)) #TODO: max, min etc ??? (asked prev)
-            if outputfile:
-                self._simulation.add_outputfile("of{}".format(e), filename=filename)
-            for i in indices:
-                #TODO: scale, time_scale ??? (asked prev)
-                self._simulation.add_line("line{}".format(i),
-                                          "{}[{}]/v".format(self._model_namespace["populationname"], i))
-                if outputfile:
-                    self._simulation.add_outputcolumn("{}".format(i),
-                                                      "{}[{}]/v".format(self._model_namespace["populationname"], i))
+            #TODO: scale, time_scale ??? (asked prev)
+            self._simulation.add_lines(line_ids, quantities)
+            if not outputfile:
+                continue
+            var_filename = filename
+            if len(variables) > 1:
+                var_filename += '_' + var
+            for c, chunk in enumerate(chunks):
+                if len(chunks) > 1:
+                    self._simulation.add_outputfile(
+                        "of{}_{}".format(e, c),
+                        filename='{}_{}.dat'.format(var_filename, c))
+                else:
+                    self._simulation.add_outputfile(
+                        "of{}".format(e), filename=var_filename + '.dat')
+                self._simulation.add_outputcolumns(indices[chunk],
+                                                   quantities[chunk])
 
     def add_eventmonitor(self, eventmonitor, filename="recording"):
         """
@@ -491,13 +790,14 @@ class NMLExporter(object):
             indices = np.asarray(indices).copy()
         # get variables #NOTE: no use variables?
         variables = eventmonitor['variables']
+        population, indices = self._recorded_population(eventmonitor, indices)
         # add event output file
-        self._simulation.add_eventoutputfile("eof", filename)
+        n_outputfiles = len(self._simulation.event_output_files)
+        self._simulation.add_eventoutputfile(
+            "eof{}".format(n_outputfiles) if n_outputfiles else "eof", filename)
         # adding eventselection for each recorded neuron
-        for i in indices:
-            self._simulation.add_eventselection("line{}".format(i),
-                    "{}[{}]".format(self._model_namespace["populationname"], i),
-                    event_port=eventmonitor['event'])
+        self._simulation.add_eventselections(population, indices,
+                                             event_port=eventmonitor['event'])
 
     def add_spikemonitor(self, spikemonitor, filename="recording"):
         """
@@ -514,18 +814,136 @@ class NMLExporter(object):
         # pass to eventmonitor
         self.add_eventmonitor(spikemonitor, filename)
 
-    def add_synapses(self, obj):
+    def _synapses_population(self, source):
+        """
+        Returns name, size and index offset of the population of the
+        source or target *source* of a Synapses object.
         """
-        TO DO - not ready to use
-        Adds synapses to the model.
+        start = 0
+        if isinstance(source, dict):
+            start = source['start']
+            size = source['stop'] - start + 1
+            source = source['group']
+        else:
+            size = self._group_sizes.get(source)
+        if source not in self._population_names:
+            raise NotImplementedError("Synapses can only connect neuron "
+                                      "groups.")
+        return self._population_names[source], size, start
+
+    def add_synapses(self, synapses, connectors, initializers):
+        """
+        Adds a ComponentType for the synapse model of *synapses* and a
+        projection between the source and target populations to the
+        network. The connections themselves are written to a separate
+        file in `export_to_file`.
+
+        Only changes of the synapse's own variables on presynaptic spikes
+        are exported, the delay of the spikes is exported as the ``delay``
+        parameter of the synapse. Changes of pre- or postsynaptic variables,
+        postsynaptic pathways and different delays for each synapse cannot
+        be expressed in LEMS synapses and raise a `NotImplementedError`,
+        summed variables are ignored with a warning.
+
         Parameters
         ----------
-        obj : brian2.Synapse
-            Synapse object
+        synapses : dict
+            Standard dictionary representation of Synapses object
+        connectors : list
+            List of the connectors (``connect`` calls) of *synapses*
+        initializers : list
+            List of initializers defined in the network
         """
-        synapse_ct = lems.ComponentType('Synapse')
-        dynamics_synapse = lems.Dynamics()
-        synapse_ct.add(dynamics_synapse)
+        name = synapses['name']
+        identifiers = synapses.get('identifiers', {})
+        synapse_ct = lems.ComponentType(name)
+        for param in self._determine_parameters(identifiers):
+            synapse_ct.add(param)
+        synapse_ct.add(lems.EventPort(name=SYNAPSE_PORT, direction='in'))
+        dynamics = lems.Dynamics()
+        equations = synapses.get('equations', {})
+        for var, equation in equations.items():
+            dimension = _determine_dimension(equation['unit'])
+            self._all_params_unit[var] = dimension
+            if equation['type'] == 'subexpression':
+                dynamics.add(lems.DerivedVariable(var, dimension=dimension,
+                                                  value=renderer.render_expr(equation['expr'])))
+                continue
+            synapse_ct.add(lems.Exposure(var, dimension=dimension))
+            dynamics.add_state_variable(lems.StateVariable(var, dimension=dimension,
+                                                           exposure=var))
+            if equation['type'] == 'differential equation':
+                dynamics.add_time_derivative(
+                    lems.TimeDerivative(var, renderer.render_expr(equation['expr'])))
+        # initial values of the synapse's variables
+        onstart = lems.OnStart()
+        for initializer in initializers:
+            if (initializer['source'] != name or
+                    initializer['variable'] not in equations):
+                continue
+            if isinstance(initializer['value'], str):
+                value = renderer.render_expr(initializer['value'])
+            elif np.size(initializer['value']) == 1:
+                value = brian_unit_to_lems(initializer['value'])
+            else:
+                logger.warn("Ignoring the per-synapse values of '{}' of "
+                            "'{}'.".format(initializer['variable'], name),
+                            once=True)
+                continue
+            onstart.add(lems.StateAssignment(initializer['variable'], value))
+        dynamics.add(onstart)
+        for summed_variable in synapses.get('summed_variables', []):
+            logger.warn("Ignoring the summed variable '{}' of '{}', summed "
+                        "variables cannot be exported.".format(summed_variable['name'],
+                                                               name),
+                        once=True)
+        # effect of presynaptic spikes
+        on_event = lems.OnEvent(SYNAPSE_PORT)
+        delay = 0*ms
+        for pathway in synapses.get('pathways', []):
+            if pathway['prepost'] != 'pre':
+                raise NotImplementedError("Synapses with postsynaptic "
+                                          "pathways cannot be exported.")
+            for statement in re.split(';|\n', pathway['code']):
+                if not statement.strip():
+                    continue
+                match = _STATEMENT.match(statement)
+                if match is None or match.group(1) not in equations:
+                    raise NotImplementedError("Cannot export '{}' of '{}', only "
+                                              "changes of the synapse's own "
+                                              "variables are supported."
+                                              "".format(statement.strip(), name))
+                var, operator, expr = match.groups()
+                if operator != '=':
+                    expr = '{} {} ({})'.format(var, operator[0], expr)
+                on_event.add_action(lems.StateAssignment(var, renderer.render_expr(expr)))
+            delay = _pathway_delay(pathway, initializers)
+        dynamics.add_event_handler(on_event)
+        synapse_ct.dynamics = dynamics
+        self._model.add_component_type(synapse_ct)
+        paramdict = {ident_name: self._unit_lems_validator(ident_value)
+                     for ident_name, ident_value in identifiers.items()}
+        if delay != 0*ms:
+            synapse_ct.add(lems.Parameter(SYNAPSE_DELAY, 'time'))
+            paramdict[SYNAPSE_DELAY] = self._unit_lems_validator(delay)
+        self._model.add(lems.Component(name + 'Syn', name, **paramdict))
+
+        # the projection only refers to the file with the connections
+        source, source_size, source_start = self._synapses_population(synapses['source'])
+        target, target_size, target_start = self._synapses_population(synapses['target'])
+        if not self._projections:
+            projection_ct = lems.ComponentType(BULK_PROJECTION)
+            for text in ('presynapticPopulation', 'postsynapticPopulation',
+                         'synapse', CONNECTION_FILE):
+                projection_ct.add(lems.Text(name=text))
+            self._model.add_component_type(projection_ct)
+        self._network.add_component(name + 'Proj', BULK_PROJECTION,
+                                    presynapticPopulation=source,
+                                    postsynapticPopulation=target,
+                                    synapse=name + 'Syn')
+        self._projections[name + 'Proj'] = (connectors, source_size,
+                                            target_size, source_start,
+                                            target_start)
 
     def add_input(self, obj, counter=''):
         """
@@ -548,12 +966,13 @@ class NMLExporter(object):
 
     def add_population(self, net_id, component_id, type_, **args):
         """
-        Sets population of neurons to resulting file.
+        Adds a population of neurons to the network of the resulting file.
 
         Parameters
         ----------
         net_id : str
-            network id
+            network id, only used for the first population which creates
+            the network
         component_id : str
             component id
         type_ : str
@@ -561,9 +980,9 @@ class NMLExporter(object):
         args : ...
             all extra keyword arguments
         """
-        nmlnetwork = NeuroMLSimpleNetwork(net_id)
-        nmlnetwork.add_component(component_id, type_, **args)
-        self._population = nmlnetwork.build()
+        if self._network is None:
+            self._network = NeuroMLSimpleNetwork(net_id)
+        self._network.add_component(component_id, type_, **args)
 
     def add_include(self, includefile):
         """
@@ -578,15 +997,17 @@ class NMLExporter(object):
         self._model.add(lems.Include(includefile))
 
     def create_lems_model(self, run_dict, constants_file=None, includes=[],
-                          recordingsname='recording'):
+                          recordingsname='recording', columns_per_file=None):
         """
         Create lems model using standard dictionary
 
         Parameters
         ----------
-        run_dict : dict
+        run_dict : list of dict
             standard dictionary representation of information required
-            for creating lems model
+            for creating lems model, one dictionary per run. Objects
+            taking part in several runs are only exported once and the
+            simulation covers the total duration of all runs.
         constants_file : str, optional
             file with units as constants definitions, if None an
             LEMS_CONSTANTS_XML is added automatically
@@ -595,6 +1016,9 @@ class NMLExporter(object):
         recordingsname : str, optional
             output of LEMS simulation recordings, values with extension
             .dat and spikes with .spikes, default 'recording'
+        columns_per_file : int, optional
+            maximum number of recorded neurons stored in a single
+            StateMonitor output file, default None (no limit)
         """
 
         # if no constants_file is specified, use LEMS_CONSTANTS_XML
@@ -607,29 +1031,68 @@ class NMLExporter(object):
         for include in INCLUDES:
             includes.add(include)
 
-        # TODO: deal with single run for now
-        single_run = run_dict[0]
-        # check initializers are defined
+        # merge the runs, objects are identified by their name so that
+        # objects taking part in several runs are only exported once
+        components = {}
         initializers = []
-        if 'initializers_connectors' in single_run:
-            for item in single_run['initializers_connectors']:
-                if item['type'] == 'initializer':
+        connectors = {}
+        duration = None
+        for run_index, single_run in enumerate(run_dict):
+            new_objects = set()
+            for (obj_name, obj_list) in single_run['components'].items():
+                merged = components.setdefault(obj_name, {})
+                for obj in obj_list:
+                    if obj['name'] not in merged:
+                        merged[obj['name']] = obj
+                        new_objects.add(obj['name'])
+                        # delays are initialized for the pathways
+                        new_objects.update(pathway['name'] for pathway
+                                           in obj.get('pathways', []))
+            # check initializers are defined
+            for item in single_run.get('initializers_connectors', []):
+                if item['type'] == 'connect':
+                    if item['synapses'] in new_objects:
+                        connectors.setdefault(item['synapses'], []).append(item)
+                    else:
+                        logger.warn("Ignoring the connections of '{}' made "
+                                    "before run {}, changes between runs "
+                                    "cannot be exported.".format(item['synapses'],
+                                                                 run_index + 1),
+                                    once=True)
+                    continue
+                if item['type'] != 'initializer':
+                    continue
+                source = item['source']
+                if isinstance(source, dict):
+                    source = source['group']
+                if source in new_objects:
                     initializers.append(item)
+                else:
+                    logger.warn("Ignoring the assignment to '{}' of '{}' "
+                                "before run {}, changes between runs cannot "
+                                "be exported.".format(item['variable'],
+                                                      source, run_index + 1),
+                                once=True)
+            if duration is None:
+                duration = single_run['duration']
+            else:
+                duration += single_run['duration']
 
-        netinputs = []
-        if 'poissoninput' in single_run['components'].keys():
-            netinputs = single_run['components']['poissoninput']
+        netinputs = list(components.get('poissoninput', {}).values())
 
         if netinputs:
             includes.add(LEMS_INPUTS)
         for include in includes:
             self.add_include(include)
 
-        if 'neurongroup' in single_run['components'].keys():
-            neuron_count = 0
-            for neurongroup in single_run['components']['neurongroup']:
-                self.add_neurongroup(neurongroup, neuron_count, initializers)
-                neuron_count += 1
+        neuron_count = 0
+        for neurongroup in components.get('neurongroup', {}).values():
+            self.add_neurongroup(neurongroup, neuron_count, initializers)
+            neuron_count += 1
+
+        for synapses in components.get('synapses', {}).values():
+            self.add_synapses(synapses, connectors.get(synapses['name'], []),
+                              initializers)
 
         # DOM structure of the whole model is constructed below
         self._dommodel = self._model.export_to_dom()
@@ -638,38 +1101,61 @@ class NMLExporter(object):
         for poisson_inp in netinputs:
             self.add_input(poisson_inp, input_counter)
             input_counter += 1
-        # A population should be created in `make_multiinstantiate`
-        # so we can add it to our DOM structure.
-        if self._population:
-            self._extend_dommodel(self._population)
+        # Populations should be created in `make_multiinstantiate`
+        # so we can add their network to our DOM structure.
+        if self._network is not None:
+            self._extend_dommodel(self._network.build())
 
         self._model_namespace['simulname'] = "sim1"
         self._simulation = NeuroMLSimulation(self._model_namespace['simulname'],
                                              self._model_namespace['networkname'])
-
-        #loop over components field of single_run
-        for (obj_name, obj_list) in single_run['components'].items():
-
-            #check unsupported
-            if obj_name == 'synapses':
-                raise NotImplementedError("Synapses are not supported yet")
+        if duration is not None:
+            self._simulation.update_simulation_attribute(
+                'length', str(duration.in_unit(ms)))
+
+        # monitors writing the same type of file get their name appended to
+        # the file name, so that they do not overwrite each other
+        recording_files = {}
+        for obj_name in ('statemonitor', 'spikemonitor', 'eventmonitor'):
+            for monitor in components.get(obj_name, {}).values():
+                if obj_name == 'statemonitor' or monitor['event'] != 'spike':
+                    extension = '.dat'
+                else:
+                    extension = '.spikes'
+                recording_files.setdefault(extension, []).append(monitor['name'])
+        shared_files = {name for names in recording_files.values()
+                        if len(names) > 1 for name in names}
+
+        def recording_name(monitor):
+            if monitor['name'] in shared_files:
+                return recordingsname + '_' + monitor['name']
+            return recordingsname
+
+        #loop over components merged from all runs
+        for (obj_name, obj_dict) in components.items():
+            obj_list = obj_dict.values()
 
             # check whether StateMonitor
             if obj_name == 'statemonitor':
                 # loop over the statemonitors defined
                 for statemonitor in obj_list:
-                    self.add_statemonitor(statemonitor, filename=recordingsname, outputfile=True)
+                    self.add_statemonitor(statemonitor,
+                                          filename=recording_name(statemonitor),
+                                          outputfile=True,
+                                          columns_per_file=columns_per_file)
 
             # check whether SpikeMonitor
             if obj_name == 'spikemonitor':
                 for spikemonitor in obj_list:
-                    self.add_spikemonitor(spikemonitor, filename=recordingsname)
+                    self.add_spikemonitor(spikemonitor,
+                                          filename=recording_name(spikemonitor))
 
             # check whether EventMonitor
             # TODO: is this valid in NML/LEMS?
             if obj_name == 'eventmonitor':
                 for eventmonitor in obj_list:
-                    self.add_eventmonitor(eventmonitor, filename=recordingsname)
+                    self.add_eventmonitor(eventmonitor,
+                                          filename=recording_name(eventmonitor))
 
         # build the simulation
         simulation = self._simulation.build()
@@ -678,18 +1164,69 @@ class NMLExporter(object):
         target = target.build()
         self._extend_dommodel(target)
 
-    def export_to_file(self, filename):
+    def export_to_file(self, filename, compress=False):
         """
-        Exports model to file *filename*
+        Exports model to file *filename*. The XML is written element by
+        element, without creating the full XML string in memory.
+
+        Parameters
+        ----------
+        filename : str
+            name of the output file, the extension ".xml" is added if it
+            has no extension
+        compress : bool, optional
+            whether to write a gzip-compressed file, in which case the
+            extension ".gz" is added to *filename*, default False. Files
+            with a ".gz" extension are always compressed.
+
+        Values of properties that differ between the neurons of a
+        population are written to a separate file for each population
+        (with the columns in the order of the header line, and values in
+        base units), named after *filename* and the population, and
+        referenced by the population's ``parameterFile`` attribute.
+        Similarly, the connections of each projection are written to a
+        file referenced by its ``connectionFile`` attribute, with the
+        presynaptic and postsynaptic index of a connection on each line.
+
+        Returns
+        -------
+        filename : str
+            name of the written file, including the added extensions
         """
         dirname = os.path.dirname(filename)
-        if not os.path.exists(dirname):
+        if dirname and not os.path.exists(dirname):
             os.mkdir(dirname)
         if len(filename.split(".")) == 1:
             filename += ".xml"
-        xmlstring = self._dommodel.toprettyxml("  ", "\n")
-        with open(filename, "w") as f:
-            f.write(xmlstring)
+        if compress and not filename.endswith(".gz"):
+            filename += ".gz"
+        basename = os.path.basename(filename).split(".")[0]
+        for population, values in self._per_neuron_values.items():
+            parameter_file = "{}_{}.dat".format(basename, population)
+            if filename.endswith(".gz"):
+                parameter_file += ".gz"
+            np.savetxt(os.path.join(dirname, parameter_file),
+                       np.column_stack(list(values.values())),
+                       header=" ".join(values.keys()))
+            for component in self._network.components:
+                if component.getAttribute("id") == population:
+                    component.setAttribute(PARAMETER_FILE, parameter_file)
+        for projection, connectivity in self._projections.items():
+            connection_file = "{}_{}.dat".format(basename, projection)
+            if filename.endswith(".gz"):
+                connection_file += ".gz"
+            _write_connections(os.path.join(dirname, connection_file),
+                               *connectivity)
+            for component in self._network.components:
+                if component.getAttribute("id") == projection:
+                    component.setAttribute(CONNECTION_FILE, connection_file)
+        if filename.endswith(".gz"):
+            f = gzip.open(filename, "wb")
+        else:
+            f = open(filename, "wb")
+        with f:
+            write_dom(self._dommodel, f, "  ", "\n")
+        return filename
 
     def _extend_dommodel(self, child):
         """
@@ -709,6 +1246,33 @@ class NMLExporter(object):
 INCLUDES = ["Simulation.xml", "NeuroML2CoreTypes.xml"]
 
 
+def _export_runs(runs, filename, compress=False, columns_per_file=None):
+    """
+    Exports the standard dictionary representation of *runs* to the
+    NeuroML2/LEMS file *filename* (without the units constants file).
+
+    Returns
+    -------
+    filename : str
+        name of the written file, including the added extensions
+    """
+    # get directory and filename
+    dirname, filename = os.path.split(filename)
+    dirname = os.path.abspath(dirname)
+    # get filename without extension
+    if len(filename.split(".")) != 1:
+        filename_ = os.path.join(dirname, 'recording_' + filename.split(".")[0])
+    else:
+        filename_ = os.path.join(dirname, 'recording_' + filename)
+    # create object for exporter class
+    exporter = NMLExporter()
+    # prepare lems model using dictionary of baseexport
+    exporter.create_lems_model(runs, recordingsname=filename_,
+                               columns_per_file=columns_per_file)
+    return exporter.export_to_file(os.path.join(dirname, filename),
+                                   compress=compress)
+
+
 class DummyCodeObject(object):
     def __init__(self, *args, **kwds):
         pass
@@ -726,30 +1290,33 @@ class LEMSDevice(BaseExporter):
     are defined in BaseExporter
     """
 
-    def build(self, filename=None, direct_call=True, lems_const_save=True):
+    def build(self, filename=None, direct_call=True, lems_const_save=True,
+              compress=False, columns_per_file=None):
         """
         Get information from BaseExport to start lems/neuroml2 export and create
         output files
+
+        Parameters
+        ----------
+        filename : str
+            name of the output file
+        direct_call : bool, optional
+            whether build() was called directly
+        lems_const_save : bool, optional
+            whether to save the file with the units defined as constants
+            next to the output file, default True
+        compress : bool, optional
+            whether to write a gzip-compressed output file, default False
+        columns_per_file : int, optional
+            maximum number of recorded neurons stored in a single
+            StateMonitor output file, default None (no limit)
         """
-        # get directory and filename
-        dirname, filename = os.path.split(filename)
-        dirname = os.path.abspath(dirname)
-        # TODO: should be extended to multiple runs
-        if len(self.runs) > 1:
-            raise NotImplementedError("Currently only single run is supported.")
-        # get filename without extension
-        if len(filename.split(".")) != 1:
-            filename_ = os.path.join(dirname, 'recording_' + filename.split(".")[0])
-        else:
-            filename_ = os.path.join(dirname, 'recording_' + filename)
-        # create object for exporter class
-        exporter = NMLExporter()
-        # prepare lems model using dictionary of baseexport
-        exporter.create_lems_model(self.runs, recordingsname=filename_)
-        exporter.export_to_file(os.path.join(dirname, filename))
+        _export_runs(self.runs, filename, compress=compress,
+                     columns_per_file=columns_per_file)
         # currently NML2/LEMS model requires units stored as constants
         # in a separate file
         if lems_const_save:
+            dirname = os.path.dirname(os.path.abspath(filename))
             shutil.copyfile(os.path.join(nmlcdpath, LEMS_CONSTANTS_XML),
                             os.path.join(dirname, LEMS_CONSTANTS_XML))
 
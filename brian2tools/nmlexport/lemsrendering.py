@@ -1,5 +1,11 @@
+from functools import lru_cache
+
 from brian2.parsing.rendering import NodeRenderer
 
+# Maximum number of rendered expressions kept in the cache
+EXPR_CACHE_SIZE = 4096
+
+
 class LEMSRenderer(NodeRenderer):
     expression_ops = NodeRenderer.expression_ops.copy()
     expression_ops.update({
@@ -31,6 +37,12 @@ class LEMSRenderer(NodeRenderer):
                        'rand': 'random',
                        'sign': 'H'}
 
+    def render_expr(self, expr, strip=True):
+        if self.auto_vectorise:
+            # the rendering depends on the state of this renderer
+            return super(LEMSRenderer, self).render_expr(expr, strip)
+        return _render_expr(type(self), expr, strip)
+
     def render_func(self, node):
         if node.id in self.lems_functions:
             return node.id
@@ -38,3 +50,13 @@ class LEMSRenderer(NodeRenderer):
             return self.brian2lems_func[node.id]
         else:
             raise ValueError("Function {} not supported".format(node.id))
+
+
+@lru_cache(maxsize=EXPR_CACHE_SIZE)
+def _render_expr(renderer_class, expr, strip):
+    """
+    Renders an expression with a default instance of ``renderer_class``. The
+    result is cached per renderer class, since subclasses may render
+    expressions differently.
+    """
+    return NodeRenderer.render_expr(renderer_class(), expr, strip)
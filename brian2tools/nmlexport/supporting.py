@@ -1,63 +1,13 @@
-import re
 import os
 import xml.dom.minidom as minidom
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
 
-from brian2.units.allunits import all_units
+import numpy as np
 from brian2 import get_or_create_dimension
 
-
-name_to_unit = {u.dispname: u for u in all_units}
-
-
-def from_string(rep):
-    """
-    Returns `Quantity` object from text representation of a value.
-
-    Parameters
-    ----------
-    rep : `str`
-        text representation of a value with unit
-
-    Returns
-    -------
-    q : `Quantity`
-        Brian Quantity object
-    """
-    # match value
-    m = re.match('-?[0-9]+\.?([0-9]+)?[eE]?-?([0-9]+)?', rep)
-    if m:
-        value = rep[0:m.end()]
-        rep = rep[m.end():]
-    else:
-        raise ValueError("Empty value given")
-    # match unit
-    m = re.match(' ?([a-zA-Z]+)', rep)
-    unit = None
-    per = None
-    if m:
-        unit = rep[0:m.end()].strip()
-        # special case with per
-        if unit == 'per':
-            mper = re.match(' ?per_([a-zA-Z]+)', rep)
-            per = rep[0:mper.end()].strip()[4:]
-            m = mper
-        rep = rep[m.end():]
-    # match exponent
-    m = re.match('-?([0-9]+)?', rep)
-    exponent = None
-    if len(rep) > 0 and m:
-        exponent = rep[0:m.end()]
-    if unit:
-        if per:
-            b2unit = 1. / name_to_unit[per]
-        else:
-            b2unit = name_to_unit[unit]
-        if value and exponent:
-            return float(value) * b2unit**float(exponent)
-        elif value:
-            return float(value) * b2unit
-    else:
-        return float(value)
+# kept here for backwards compatibility
+from brian2tools.nmlutils.utils import name_to_unit, from_string
 
 
 def brian_unit_to_lems(valunit):
@@ -139,6 +89,57 @@ def read_nml_units(nmlcdpath=""):
             lems_units.append(uc.getAttribute('symbol'))
     return lems_units
 
+
+def write_dom(node, stream, indent="  ", newl="\n"):
+    """
+    Writes a DOM structure to *stream* element by element, with the same
+    indentation as `xml.dom.minidom.Node.toprettyxml` but without building
+    the whole XML string in memory first.
+
+    Parameters
+    ----------
+    node : `xml.dom.minidom.Document` or `xml.dom.minidom.Element`
+        DOM structure to write
+    stream : file object
+        Binary stream the UTF-8 encoded XML is written to
+    indent : str, optional
+        indentation for each level of the DOM tree, default two spaces
+    newl : str, optional
+        string written at the end of each line, default newline
+    """
+    generator = XMLGenerator(stream, encoding="utf-8",
+                             short_empty_elements=True)
+    generator.startDocument()
+    if node.nodeType == node.DOCUMENT_NODE:
+        node = node.documentElement
+    _write_element(generator, node, 0, indent, newl)
+    generator.ignorableWhitespace(newl)
+    generator.endDocument()
+
+
+def _write_element(generator, element, level, indent, newl):
+    """
+    Writes *element* and its children with the *generator*, an element
+    with only text content is written on a single line.
+    """
+    generator.startElement(element.tagName,
+                           AttributesImpl(dict(element.attributes.items())))
+    children = element.childNodes
+    if (len(children) == 1 and
+            children[0].nodeType in (element.TEXT_NODE,
+                                     element.CDATA_SECTION_NODE)):
+        generator.characters(children[0].data)
+    elif children:
+        for child in children:
+            generator.ignorableWhitespace(newl + indent*(level + 1))
+            if child.nodeType == element.ELEMENT_NODE:
+                _write_element(generator, child, level + 1, indent, newl)
+            elif child.nodeType in (element.TEXT_NODE,
+                                    element.CDATA_SECTION_NODE):
+                generator.characters(child.data.strip())
+        generator.ignorableWhitespace(newl + indent*level)
+    generator.endElement(element.tagName)
+
 ########################################
 # All NeuroML2 syntax creation helpers
 ########################################
@@ -252,13 +253,34 @@ class NeuroMLSimulation(object):
         time_scale : str
             time scale of a line
         """
+        self.add_lines([linid], [quantity], scale, time_scale)
+
+    def add_lines(self, linids, quantities, scale="1mV", time_scale="1ms"):
+        """
+        Adds a Line element for each id and quantity to a recently added
+        Display.
+
+        Parameters
+        ----------
+        linids : sequence of str
+            line ids
+        quantities : sequence of str
+            measures to plot, one for each line id
+        scale : str
+            scale of the functions
+        time_scale : str
+            time scale of the lines
+        """
         assert self.displays, "You need to add display first"
-        line = self.doc.createElement('Line')
-        attributes = [("id", linid), ("quantity", quantity),
-                      ("scale", scale), ("timeScale", time_scale)]
-        for attr_name, attr_value in attributes:
-            line.setAttribute(attr_name, attr_value)
-        self.lines[self._disp_idx].append(line)
+        lines = self.lines[self._disp_idx]
+        create_element = self.doc.createElement
+        for linid, quantity in zip(linids, quantities):
+            line = create_element('Line')
+            line.setAttribute("id", linid)
+            line.setAttribute("quantity", quantity)
+            line.setAttribute("scale", scale)
+            line.setAttribute("timeScale", time_scale)
+            lines.append(line)
 
     def add_outputfile(self, outfileid, filename="recordings.dat"):
         """
@@ -289,12 +311,28 @@ class NeuroMLSimulation(object):
         quantity : str
             measure to store in a column
         """
+        self.add_outputcolumns([ocid], [quantity])
+
+    def add_outputcolumns(self, ocids, quantities):
+        """
+        Adds an OutputColumn element for each id and quantity to a recently
+        added OutputFile tag.
+
+        Parameters
+        ----------
+        ocids : sequence of str
+            OutputColumn ids
+        quantities : sequence of str
+            measures to store in the columns, one for each id
+        """
         assert self.output_files, "You need to add output_files first"
-        outputcolumn = self.doc.createElement('OutputColumn')
-        attributes = [("id", ocid), ("quantity", quantity)]
-        for attr_name, attr_value in attributes:
-            outputcolumn.setAttribute(attr_name, attr_value)
-        self.outcolumns[self._output_idx].append(outputcolumn)
+        outcolumns = self.outcolumns[self._output_idx]
+        create_element = self.doc.createElement
+        for ocid, quantity in zip(ocids, quantities):
+            outputcolumn = create_element('OutputColumn')
+            outputcolumn.setAttribute("id", ocid)
+            outputcolumn.setAttribute("quantity", quantity)
+            outcolumns.append(outputcolumn)
 
     def add_eventoutputfile(self, outfileid, filename="recordings.spikes", format_="TIME_ID"):
         """
@@ -338,6 +376,37 @@ class NeuroMLSimulation(object):
             eventselection.setAttribute(attr_name, attr_value)
         self.eventselections[self._event_output_idx].append(eventselection)
 
+    def add_eventselections(self, population, indices, event_port="spike",
+                            id_prefix="line"):
+        """
+        Adds an EventSelection element for each of the given neurons of a
+        population to a recently added EventOutputFile.
+
+        Parameters
+        ----------
+        population : str
+            name of the population the neurons belong to
+        indices : array-like of int
+            indices of the selected neurons
+        event_port : str
+            event port name, default 'spike'
+        id_prefix : str
+            prefix of the EventSelection ids, followed by the neuron
+            index, default 'line'
+        """
+        assert self.event_output_files, "You need to add EventOutputFile first"
+        indices = np.asarray(indices).ravel().astype(str)
+        esids = np.char.add(id_prefix, indices)
+        selects = np.char.add(np.char.add(population + '[', indices), ']')
+        eventselections = self.eventselections[self._event_output_idx]
+        create_element = self.doc.createElement
+        for esid, select in zip(esids.tolist(), selects.tolist()):
+            eventselection = create_element('EventSelection')
+            eventselection.setAttribute("id", esid)
+            eventselection.setAttribute("select", select)
+            eventselection.setAttribute("eventPort", event_port)
+            eventselections.append(eventselection)
+
     def build(self):
         '''
         Builds NeuroML DOM structure of Simulation. It returns DOM
@@ -0,0 +1,3 @@
+from .batch import load_morphologies
+from .cache import load_cached_morphology
+from .streaming import load_morphology_streaming
@@ -0,0 +1,99 @@
+"""
+Import of many NeuroML morphologies in parallel processes.
+"""
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from brian2.utils.logger import get_logger
+
+from .cache import load_cached_morphology
+from .nml import NMLMorphology
+
+__all__ = ['load_morphologies']
+
+logger = get_logger(__name__)
+
+
+def _load_description(filename, name_heuristic, validate, cache_dir):
+    """
+    Imports a single .nml file, catching all errors so that a failing file
+    does not abort the import of the others.
+    """
+    start = time.perf_counter()
+    description, error = None, None
+    try:
+        if cache_dir is not None:
+            description = load_cached_morphology(filename, cache_dir,
+                                                 name_heuristic=name_heuristic,
+                                                 validate=validate)
+        else:
+            nml_object = NMLMorphology(filename, name_heuristic=name_heuristic,
+                                       validate=validate)
+            description = nml_object.describe()
+    except Exception:
+        error = traceback.format_exc()
+    return {'filename': filename, 'description': description,
+            'time': time.perf_counter() - start, 'error': error}
+
+
+def load_morphologies(paths, workers=None, name_heuristic=True,
+                      validate=True, cache_dir=None):
+    """
+    Imports many .nml files, using a pool of worker processes. Each worker
+    process parses and validates the files included by several cells (e.g.
+    channel definitions) only once.
+
+    Parameters
+    ----------
+    paths : list of str
+        File names of the .nml files to import.
+    workers : int, optional
+        number of worker processes, by default the number of processors.
+        With a single worker, the files are imported in the current process.
+    name_heuristic : bool, optional
+        Whether to determine the sections from the segment names, see
+        `NMLMorphology`. Default True
+    validate : bool, optional
+        Whether to validate the files against the NeuroML schema, default
+        True
+    cache_dir : str, optional
+        Directory of a persistent cache of converted morphologies (see
+        `load_cached_morphology`), default None (no cache).
+
+    Returns
+    -------
+    results : list of dict
+        For each file (in the order of *paths*) a dictionary with the keys
+        ``'filename'``, ``'description'`` (a `MorphologyDescription`, whose
+        ``morphology`` attribute creates the Brian `Morphology` on first
+        access, or None), ``'time'`` (the time of the import in seconds) and
+        ``'error'`` (the traceback of a failed import, or None).
+    """
+    tasks = [(filename, name_heuristic, validate, cache_dir)
+             for filename in paths]
+
+    if workers is not None and workers <= 1:
+        results = [_load_description(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_load_description, *task)
+                       for task in tasks]
+            results = []
+            for (filename, _, _, _), future in zip(tasks, futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    # the worker process itself failed
+                    results.append({'filename': filename,
+                                    'description': None, 'time': None,
+                                    'error': traceback.format_exc()})
+
+    for result in results:
+        if result['error'] is None:
+            logger.debug("Imported '{}' in {:.2f}s".format(result['filename'],
+                                                           result['time']))
+        else:
+            logger.warn("Import of '{}' failed:\n{}".format(result['filename'],
+                                                            result['error']))
+    return results
@@ -0,0 +1,157 @@
+"""
+Persistent on-disk cache of morphologies imported from NeuroML files.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+
+import numpy as np
+from neuroml.utils import validate_neuroml2
+from brian2.utils.logger import get_logger
+
+from .nml import NMLMorphology, MorphologyDescription
+
+__all__ = ['load_cached_morphology']
+
+logger = get_logger(__name__)
+
+#: Default directory of the cache files
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.brian2tools',
+                                 'nmlimport_cache')
+
+# Increase when the format of the cache files changes
+CACHE_VERSION = 1
+
+
+def _cache_key(filename, name_heuristic):
+    """
+    Returns the cache key of *filename*, a hash of its content and of all
+    options that change the conversion result.
+    """
+    sha = hashlib.sha256()
+    sha.update('{} {}\n'.format(CACHE_VERSION, name_heuristic).encode())
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _write_atomically(filename, write):
+    """
+    Writes a file with the function *write* (called with a binary file
+    object) to a temporary file that is then renamed, so that other
+    processes never see incomplete files.
+    """
+    handle, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                            suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def _save_description(description, basename, validated):
+    """
+    Stores *description* in the files ``<basename>.npy`` (all section points
+    as a single array) and ``<basename>.pkl`` (everything else).
+    """
+    points = np.concatenate(description.section_points)
+    offsets = np.cumsum([0] + [len(p) for p in description.section_points])
+    meta = {'section_names': description.section_names,
+            'section_parents': description.section_parents,
+            'offsets': offsets,
+            'segment_groups': description.segment_groups,
+            'properties': description.properties,
+            'channel_properties': description.channel_properties,
+            'validated': validated}
+    # the metadata file is written last, it marks a complete cache entry
+    _write_atomically(basename + '.npy', lambda f: np.save(f, points))
+    _write_atomically(basename + '.pkl',
+                      lambda f: pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL))
+
+
+def _load_description(basename):
+    """
+    Loads a description stored by `_save_description`, memory-mapping the
+    section points. Returns ``(description, validated)``.
+    """
+    with open(basename + '.pkl', 'rb') as f:
+        meta = pickle.load(f)
+    points = np.load(basename + '.npy', mmap_mode='r')
+    offsets = meta['offsets']
+    section_points = [points[start:stop]
+                      for start, stop in zip(offsets[:-1], offsets[1:])]
+    description = MorphologyDescription(meta['section_names'],
+                                        meta['section_parents'],
+                                        section_points,
+                                        meta['segment_groups'],
+                                        meta['properties'],
+                                        meta['channel_properties'])
+    return description, meta['validated']
+
+
+def _mark_validated(basename):
+    """
+    Records in the metadata file of a cache entry that the file has been
+    validated, so that it is not validated again on later loads.
+    """
+    with open(basename + '.pkl', 'rb') as f:
+        meta = pickle.load(f)
+    meta['validated'] = True
+    _write_atomically(basename + '.pkl',
+                      lambda f: pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL))
+
+
+def load_cached_morphology(filename, cache_dir=None, name_heuristic=True,
+                           validate=True):
+    """
+    Imports the morphology of a .nml file, using a persistent cache of
+    converted morphologies. The cache is keyed by the content of the file,
+    so that a modified file is converted again. Note that changes of
+    included files do not invalidate the cache entry.
+
+    Parameters
+    ----------
+    filename : str
+        File name of the .nml file.
+    cache_dir : str, optional
+        Directory of the cache files, `DEFAULT_CACHE_DIR` by default.
+    name_heuristic : bool, optional
+        Whether to determine the sections from the segment names, see
+        `NMLMorphology`. Default True
+    validate : bool, optional
+        Whether to validate the file against the NeuroML schema when it is
+        not found in the cache (or has been stored without validation).
+        Default True
+
+    Returns
+    -------
+    MorphologyDescription
+        Description of the morphology and the biophysical properties, with
+        the section points memory-mapped from the cache file.
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    basename = os.path.join(cache_dir, _cache_key(filename, name_heuristic))
+    if os.path.exists(basename + '.pkl'):
+        try:
+            description, validated = _load_description(basename)
+        except Exception as ex:
+            logger.warn("Could not read cache file '{}', the file will be "
+                        "converted again: {}".format(basename, ex))
+        else:
+            if validate and not validated:
+                validate_neuroml2(os.path.abspath(filename))
+                _mark_validated(basename)
+            logger.debug("Loaded '{}' from the cache".format(filename))
+            return description
+
+    description = NMLMorphology(filename, name_heuristic=name_heuristic,
+                                validate=validate).describe()
+    os.makedirs(cache_dir, exist_ok=True)
+    _save_description(description, basename, validate)
+    return description
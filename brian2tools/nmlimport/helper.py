@@ -2,8 +2,11 @@ from pprint import pformat
 from collections import defaultdict
 
 
-# Returns parent segment
+# Returns parent segment, `segments` is either a list of segments or a
+# dictionary of segments with their ids as keys.
 def get_parent_segment(segment, segments):
+    if isinstance(segments, dict):
+        return segments.get(segment.parent.segments)
     for s in segments:
         if s.id == segment.parent.segments:
             return s
@@ -1,27 +1,110 @@
 import re
 from os import getcwd
 from copy import deepcopy
-from os.path import abspath, dirname, join, exists
+from os.path import abspath, dirname, join, exists, getmtime
+from collections import OrderedDict
+from functools import cached_property
 import itertools
 
+import numpy as np
 import neuroml.loaders as loaders
+from neuroml.nml.nml import GeneratedsSuper
 from neuroml.utils import validate_neuroml2
 from brian2 import Morphology, SpatialNeuron
 from brian2.utils.logger import get_logger
 from brian2.spatialneuron.morphology import Section
 from brian2.units import *
 from brian2.equations.equations import Equations
-from brian2tools.nmlutils.utils import string_to_quantity
+from brian2tools.nmlutils.utils import (string_to_quantity,
+                                       strings_to_quantity)
 
 from .helper import *
 
 logger = get_logger(__name__)
 
+#: Maximum number of parsed .nml documents kept in the cache
+NML_DOC_CACHE_SIZE = 128
+
+# Parsed .nml documents, mapping absolute file paths to (modification time,
+# document, validated) tuples
+_nml_doc_cache = OrderedDict()
+
 
 class ValidationException(Exception):
     pass
 
 
+def clear_nml_doc_cache():
+    """
+    Removes all parsed .nml documents from the cache used by `NMLMorphology`.
+    """
+    _nml_doc_cache.clear()
+
+
+def _copy_doc(obj, parent=None):
+    """
+    Returns a copy of the document *obj* in which all NeuroML elements (cells,
+    segments, points, ...) and their lists are copied, so that neither
+    merging included documents nor changes to the returned document affect
+    the cached document. This is considerably faster than `deepcopy`.
+    """
+    cls = type(obj)
+    new = cls.__new__(cls)
+    attributes = dict(obj.__dict__)
+    new.__dict__ = attributes
+    for key, value in attributes.items():
+        if type(value) is list:
+            attributes[key] = [_copy_doc(item, new)
+                               if isinstance(item, GeneratedsSuper) else item
+                               for item in value]
+        elif type(value) is dict:
+            attributes[key] = dict(value)
+        elif isinstance(value, GeneratedsSuper) and not key.endswith('_'):
+            # attributes ending with "_" refer to e.g. the parent element
+            attributes[key] = _copy_doc(value, new)
+    if parent is not None and 'parent_object_' in attributes:
+        attributes['parent_object_'] = parent
+    return new
+
+
+def _load_nml_doc(file_path, validate=True):
+    """
+    Loads (and validates) the .nml file at the absolute path *file_path*.
+    Parsed documents are cached, and reused as long as the file has not
+    been modified.
+
+    Parameters
+    ----------
+    file_path: str
+        Absolute path of the .nml file.
+    validate: bool, optional
+        Whether to validate the file against the NeuroML schema.
+
+    Returns
+    -------
+    NeuroMLDocument
+        The loaded document.
+    """
+    mtime = getmtime(file_path)
+    doc, validated = None, False
+    cached = _nml_doc_cache.get(file_path)
+    if cached is not None and cached[0] == mtime:
+        _, doc, validated = cached
+        _nml_doc_cache.move_to_end(file_path)
+
+    if validate and not validated:
+        validate_neuroml2(file_path)
+        logger.info("Validated provided .nml file")
+        validated = True
+    if doc is None:
+        doc = loaders.NeuroMLLoader.load(file_path)
+
+    _nml_doc_cache[file_path] = (mtime, doc, validated)
+    if len(_nml_doc_cache) > NML_DOC_CACHE_SIZE:
+        _nml_doc_cache.popitem(last=False)
+    return _copy_doc(doc)
+
+
 def validate_morphology(segments):
     """
     Validates if the segments are connected to each other or not.
@@ -64,6 +147,162 @@ def validate_morphology(segments):
         raise
 
 
+def _get_group_values(obj_list):
+    """
+    Returns a dictionary mapping the segment groups of the given property
+    objects (e.g. resistivities) to their values.
+    """
+    values = strings_to_quantity([o.value for o in obj_list])
+    return dict(zip([o.segment_groups for o in obj_list], values))
+
+
+def _get_threshold(bio_prop):
+    """
+    Returns the spike threshold of the biophysical properties, or None if
+    they do not define a single threshold.
+    """
+    spike_threshes = bio_prop.membrane_properties.spike_threshes
+    if len(spike_threshes) != 1:
+        return None
+    return string_to_quantity(spike_threshes[0].value)
+
+
+def _resolve_segment_group(group_id, get_group, resolved):
+    """
+    Returns the segment ids of all segments of the SegmentGroup *group_id*,
+    including the segments of all (recursively) included SegmentGroups.
+
+    Parameters
+    ----------
+    group_id: str
+        SegmentGroup's id
+    get_group: function
+        Function returning the member segment ids and the ids of the
+        included SegmentGroups of a SegmentGroup (or None if the group does
+        not exist).
+    resolved: dict
+        Dictionary of already resolved SegmentGroups (mapping group ids to
+        segment ids), updated with all SegmentGroups resolved by this call.
+
+    Returns
+    -------
+    ndarray
+        Sorted array of unique segment ids
+    """
+    if group_id in resolved:
+        return resolved[group_id]
+
+    # Resolves the SegmentGroups included inside the parent SegmentGroup,
+    # using an explicit stack to detect cyclic includes.
+    stack = [group_id]
+    on_stack = {group_id}
+    while stack:
+        grp_id = stack[-1]
+        grp = get_group(grp_id)
+        if grp is None:
+            logger.warning("SegmentGroup `{}` does not exist".format(grp_id))
+            grp = ([], [])
+        members, includes = grp
+        pending = [g for g in includes if g not in resolved]
+        for g in pending:
+            if g in on_stack:
+                raise ValueError("SegmentGroup `{}` includes itself "
+                                 "(via {})".format(g, " -> ".join(stack)))
+        if pending:
+            stack.append(pending[0])
+            on_stack.add(pending[0])
+            continue
+        resolved[grp_id] = np.unique(np.concatenate(
+            [np.asarray(members, dtype=int)] +
+            [resolved[g] for g in includes]))
+        stack.pop()
+        on_stack.remove(grp_id)
+    return resolved[group_id]
+
+
+def _to_brian_ids(group_id, grp_ids, nml_ids, brian_ids):
+    """
+    Converts the segment ids *grp_ids* of the SegmentGroup *group_id* to
+    the indices of the compartments in Brian's morphology, given the
+    mapping from the sorted segment ids *nml_ids* to *brian_ids*.
+    """
+    positions = np.searchsorted(nml_ids, grp_ids)
+    unknown = (positions == len(nml_ids)) | \
+              (nml_ids[np.minimum(positions, len(nml_ids) - 1)] != grp_ids)
+    if np.any(unknown):
+        raise KeyError("SegmentGroup `{}` refers to unknown segments "
+                       "{}".format(group_id, list(grp_ids[unknown])))
+    return np.unique(brian_ids[positions])
+
+
+def _section_from_points(points):
+    """
+    Returns a Brian `Section` from an array of the x, y, z coordinates and
+    the diameter (in um) of its start point and the distal points of all
+    its compartments.
+    """
+    return Section(n=len(points) - 1, x=points[:, 0] * um,
+                   y=points[:, 1] * um, z=points[:, 2] * um,
+                   diameter=points[:, 3] * um)
+
+
+class MorphologyDescription(object):
+    """
+    A lightweight, picklable description of a morphology and its biophysical
+    properties extracted from a .nml file (see `NMLMorphology.describe`).
+    The Brian `Morphology` object is only created when the `morphology`
+    attribute is accessed for the first time.
+
+    Parameters
+    ----------
+    section_names: list
+        Names of all sections, in depth-first order (the first one is the
+        root section).
+    section_parents: ndarray
+        Index of the parent of each section (-1 for the root section).
+    section_points: list
+        For each section, an array of the x, y, z coordinates and diameter
+        (in um) of its start point and the end points of its compartments,
+        with coordinates relative to the start point.
+    segment_groups: dict
+        Resolved segment ids of each SegmentGroup.
+    properties: dict
+        Biophysical properties dictionary.
+    channel_properties: dict
+        Mapping from segment groups to channel properties.
+    """
+
+    def __init__(self, section_names, section_parents, section_points,
+                 segment_groups, properties, channel_properties):
+        self.section_names = section_names
+        self.section_parents = section_parents
+        self.section_points = section_points
+        self.segment_groups = segment_groups
+        self.properties = properties
+        self.channel_properties = channel_properties
+        self._morphology = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the Brian morphology is recreated on demand
+        state['_morphology'] = None
+        return state
+
+    @property
+    def morphology(self):
+        """
+        The Brian `Morphology` object described by this object.
+        """
+        if self._morphology is None:
+            sections = [_section_from_points(points)
+                        for points in self.section_points]
+            for idx in range(1, len(sections)):
+                parent = sections[self.section_parents[idx]]
+                parent[self.section_names[idx]] = sections[idx]
+            self._morphology = sections[0]
+        return self._morphology
+
+
 class NMLMorphology(object):
     """
         A class that extracts and store all morphology related information
@@ -80,7 +319,7 @@ class NMLMorphology(object):
             self.segmentList = []
             self.name = 'soma'
 
-    def __init__(self, file_obj, name_heuristic=True):
+    def __init__(self, file_obj, name_heuristic=True, validate=True):
         """
         Initializes NMLMorphology Class
         Parameters
@@ -94,27 +333,117 @@ class NMLMorphology(object):
             segments of the section. When set to False, all linearly
             connected segments combines to form a section and naming
             convention sec{unique_integer} is followed.
+        validate: bool
+            Whether to validate the .nml file (and all included files)
+            against the NeuroML schema. Files given by their path are only
+            parsed and validated once per process, as long as they are not
+            modified.
         """
         self.file_obj = file_obj
         self.name_heuristic = name_heuristic
+        self.validate = validate
         self.incremental_id = 0
         self.doc = self._get_nml_doc(self.file_obj)
-        cell = self.doc.cells[0]
-        self.morph = cell.morphology
+        self.cell = self.doc.cells[0]
+        self.morph = self.cell.morphology
+        # index of all segments and groups, built once to avoid linear
+        # searches for every segment
+        self.seg_dict = self._get_segment_dict(self.morph.segments)
+        self.group_dict = self._get_group_dict(self.morph)
         self.segments = self._adjust_morph_object(self.morph.segments)
-
-        section = self.SectionObject()
-        self.seg_dict = self._get_segment_dict(self.segments)
         self.children = get_child_segments(self.segments)
         self.root = self._get_root_segment(self.segments)
-        self.section = self._create_tree(section, self.root)
-        self.morphology = self.build_morphology(self.section)
-        self.segment_groups = self.get_resolved_group_ids(self.morph)
+        # equations of each ion channel, created on demand
+        self._channel_equations = {}
 
-        # biophysical Properties
-        self.properties = self._get_properties(cell.biophysical_properties)
-        self.channel_properties = self._get_channel_props(
-            cell.biophysical_properties.membrane_properties.channel_densities)
+    # The following attributes are only computed when they are accessed for
+    # the first time, e.g. a morphology that is only used for plotting does
+    # not need its segment groups or biophysical properties.
+
+    @cached_property
+    def section(self):
+        """
+        Section tree (of `SectionObject` nodes) of the morphology.
+        """
+        return self._create_tree(self.SectionObject(), self.root)
+
+    @cached_property
+    def morphology(self):
+        """
+        Brian `Morphology` object created from the .nml file.
+        """
+        return self.build_morphology(self.section)
+
+    @cached_property
+    def segment_groups(self):
+        """
+        Resolved segment ids of each SegmentGroup, see
+        `get_resolved_group_ids`.
+        """
+        return self.get_resolved_group_ids(self.morph)
+
+    @cached_property
+    def properties(self):
+        """
+        Dictionary of the biophysical properties (threshold, refractoriness,
+        specific capacitance and intracellular resistivity).
+        """
+        return self._get_properties(self.cell.biophysical_properties)
+
+    @cached_property
+    def Ri(self):
+        """
+        Intracellular resistivity of each segment group.
+        """
+        bio_prop = self.cell.biophysical_properties
+        return _get_group_values(bio_prop.intracellular_properties.resistivities)
+
+    @cached_property
+    def Cm(self):
+        """
+        Specific membrane capacitance of each segment group.
+        """
+        bio_prop = self.cell.biophysical_properties
+        return _get_group_values(bio_prop.membrane_properties.specific_capacitances)
+
+    @cached_property
+    def threshold(self):
+        """
+        Spike threshold, or None if the cell does not define a single
+        threshold.
+        """
+        return _get_threshold(self.cell.biophysical_properties)
+
+    @cached_property
+    def threshold_string(self):
+        """
+        Threshold condition (e.g. ``'v > 0. * volt'``), or None if the cell
+        does not define a single threshold.
+        """
+        if self.threshold is None:
+            return None
+        return 'v > {}'.format(repr(self.threshold))
+
+    @cached_property
+    def channel_properties(self):
+        """
+        Mapping from segment groups to the conductance densities and
+        reversal potentials of the ion channels.
+        """
+        membrane_properties = self.cell.biophysical_properties.membrane_properties
+        return self._get_channel_props(membrane_properties.channel_densities)
+
+    @cached_property
+    def ion_channels(self):
+        """
+        Dictionary of all ion channels defined in the .nml file (and its
+        includes), with their ids as keys.
+        """
+        channels = {}
+        for c in itertools.chain(getattr(self.doc, 'ion_channel', []),
+                                 getattr(self.doc, 'ion_channel_hhs', [])):
+            channels.setdefault(c.id, c)
+        return channels
 
     def _get_nml_doc(self, file_obj):
         """
@@ -164,13 +493,13 @@ class NMLMorphology(object):
         if isinstance(file_obj, str):
             # Generate absolute path if not provided already
             file_obj = abspath(file_obj)
-
-        # Validating NeuroML file
-        validate_neuroml2(deepcopy(file_obj))
-        logger.info("Validated provided .nml file")
-
-        # Load nml file
-        doc = loaders.NeuroMLLoader.load(file_obj)
+            doc = _load_nml_doc(file_obj, self.validate)
+        else:
+            if self.validate:
+                # Validating NeuroML file
+                validate_neuroml2(deepcopy(file_obj))
+                logger.info("Validated provided .nml file")
+            doc = loaders.NeuroMLLoader.load(file_obj)
         logger.info("Loaded morphology")
 
         if not doc.includes:
@@ -190,8 +519,7 @@ class NMLMorphology(object):
 
     def build_morphology(self, section, parent_section=None):
         """
-        A recursive function that converts Section tree to a Brian Morphology
-        object.
+        Converts Section tree to a Brian Morphology object.
 
         Parameters
         ----------
@@ -208,12 +536,43 @@ class NMLMorphology(object):
             Generated Brian morphology object.
         """
 
-        sec = self._build_section(section, parent_section)
-        for s in section.sectionList:
-            sec[s.name] = self.build_morphology(s, section)
-        return sec
+        root = self._build_section(section, parent_section)
+        # sections are converted iteratively (not recursively), so that deep
+        # morphologies do not exceed the recursion limit
+        stack = [(root, section)]
+        while stack:
+            sec, section = stack.pop()
+            for s in section.sectionList:
+                child = self._build_section(s, section)
+                sec[s.name] = child
+                stack.append((child, s))
+        return root
+
+    def describe(self):
+        """
+        Returns a lightweight, picklable description of the morphology and
+        of the biophysical properties, e.g. to send it to another process.
 
-    def get_segment_group_ids(self, group_id, morph):
+        Returns
+        -------
+        MorphologyDescription
+            Description from which the Brian `Morphology` can be created.
+        """
+        names, parents, points = [], [], []
+        stack = [(self.section, None, -1)]
+        while stack:
+            section, parent_section, parent = stack.pop()
+            index = len(names)
+            names.append(section.name)
+            parents.append(parent)
+            points.append(self._section_points(section, parent_section))
+            stack.extend((s, section, index)
+                         for s in reversed(section.sectionList))
+        return MorphologyDescription(names, np.array(parents, dtype=int),
+                                     points, self.segment_groups,
+                                     self.properties, self.channel_properties)
+
+    def get_segment_group_ids(self, group_id, morph, resolved=None):
         """
         Returns segment ids of all segments of a SegmentGroup with id
         `group_id` present in .nml file.
@@ -224,33 +583,27 @@ class NMLMorphology(object):
             SegmentGroup's id/name whose information is required.
         morph: Morphology
             Brian's morphology object created from .nml file.
+        resolved: dict, optional
+            Dictionary of already resolved SegmentGroups (mapping group ids
+            to segment ids), which is updated with all the SegmentGroups
+            resolved by this call. Used to resolve each included
+            SegmentGroup only once when resolving several groups.
+
         Returns
         -------
-        list
-            List of segment ids
-        """
-
-        # Appends member segment ids to list.
-        def resolve_member(mem_list, members):
-            if members is not None:
-                for m in members:
-                    mem_list.append(m.segments)
-
-        # Resolves SegmentGroup's included inside parent SegmentGroup.
-        def resolve_includes(l, grp, m):
-            if grp.includes is not None:
-                for g in grp.includes:
-                    resolve_includes(l, self._get_segment_group(m,
-                                                                g.segment_groups),
-                                     m)
-            resolve_member(l, grp.members)
-
-        id_list = []
-        for g in morph.segment_groups:
-            if g.id == group_id:
-                resolve_includes(id_list, g, morph)
-                resolve_member(id_list, g.members)
-        return id_list
+        ndarray
+            Sorted array of unique segment ids
+        """
+        def get_group(grp_id):
+            grp = self._get_segment_group(morph, grp_id)
+            if grp is None:
+                return None
+            return ([m.segments for m in grp.members or []],
+                    [g.segment_groups for g in grp.includes or []])
+
+        if resolved is None:
+            resolved = {}
+        return _resolve_segment_group(group_id, get_group, resolved)
 
     def get_resolved_group_ids(self, m):
         """
@@ -262,7 +615,8 @@ class NMLMorphology(object):
         -------
         dict
             A dictionary of resolved segment ids of each SegmentGroup,
-            here each SegmentGroup's id is a key of this dictionary.
+            here each SegmentGroup's id is a key of this dictionary and
+            the ids are given as sorted arrays.
         """
 
         # Returns id mappings of segments present in .nml file
@@ -275,12 +629,19 @@ class NMLMorphology(object):
             self._perform_dfs(mapping, parent_node, counter, children)
             return mapping
 
+        # the mapping is the same for all groups, store it as arrays of
+        # sorted .nml ids and the corresponding Brian ids
+        id_map = get_id_mappings(m.segments)
+        nml_ids = np.array(sorted(id_map), dtype=int)
+        brian_ids = np.array([id_map[nml_id] for nml_id in nml_ids],
+                             dtype=int)
+
         resolved_ids = {}
+        resolved_groups = {}
         for group in m.segment_groups:
-            grp_ids = self.get_segment_group_ids(group.id, m)
-            id_map = get_id_mappings(m.segments)
-            resolved_ids[group.id] = list(set([id_map[grp_id] for grp_id in
-                                               grp_ids]))
+            grp_ids = self.get_segment_group_ids(group.id, m, resolved_groups)
+            resolved_ids[group.id] = _to_brian_ids(group.id, grp_ids,
+                                                   nml_ids, brian_ids)
         return resolved_ids
 
     def _is_heuristically_sep(self, section, seg_id):
@@ -354,27 +715,38 @@ class NMLMorphology(object):
             section.sectionList.append(sec)
             return sec
 
-        section.segmentList.append(seg)
-        if len(self.children[seg.id]) > 1 or seg.name == "soma":
-            for seg_id in self.children[seg.id]:
-                self._create_tree(intialize_section(section, seg_id),
-                                  self.seg_dict[seg_id])
-        elif len(self.children[seg.id]) == 1:
-            if self.name_heuristic:
-                if self._is_heuristically_sep(section, seg.id):
-                    self._create_tree(intialize_section(section, seg.id),
-                                      self.seg_dict[self.children[seg.id][0]])
+        # Sections that still have to be created, as (parent section, id of
+        # the segment that determines the name, first segment) tuples. An
+        # explicit stack (instead of recursion) is used to support long
+        # unbranched morphologies, sections are created in the same order
+        # as by a depth-first traversal.
+        root = section
+        stack = [(section, None, seg)]
+        while stack:
+            section, name_id, seg = stack.pop()
+            if name_id is not None:
+                section = intialize_section(section, name_id)
+            while seg is not None:
+                section.segmentList.append(seg)
+                children = self.children[seg.id]
+                if len(children) > 1 or seg.name == "soma":
+                    stack.extend((section, child_id, self.seg_dict[child_id])
+                                 for child_id in reversed(children))
+                    seg = None
+                elif len(children) == 1:
+                    child = self.seg_dict[children[0]]
+                    if self.name_heuristic:
+                        if self._is_heuristically_sep(section, seg.id):
+                            section = intialize_section(section, seg.id)
+                        else:
+                            # separate integer from the end of segment name
+                            m = re.search(r'\d+$', child.name)
+                            section.name = '{}_{}'.format(section.name,
+                                                          m.group())
+                    seg = child
                 else:
-                    seg_name = self.seg_dict[self.children[seg.id][0]].name
-                    # separate integer from the end of segment name
-                    m = re.search(r'\d+$', seg_name)
-                    section.name = '{}_{}'.format(section.name, m.group())
-                    self._create_tree(section,
-                                      self.seg_dict[self.children[seg.id][0]])
-            else:
-                self._create_tree(section,
-                                  self.seg_dict[self.children[seg.id][0]])
-        return section
+                    seg = None
+        return root
 
     def _build_section(self, section, section_parent):
         """
@@ -393,26 +765,27 @@ class NMLMorphology(object):
         Section
             Brian's section object.
         """
-        shift = section.segmentList[0].proximal
-        x, y, z = [0], [0], [0]
-        diameter = [section_parent.segmentList[-1].distal.diameter if
-                    section_parent is not None else section.segmentList[
-            0].proximal.diameter]
+        return _section_from_points(self._section_points(section,
+                                                         section_parent))
 
-        for s in section.segmentList:
-            x.append(s.distal.x - shift.x)
-            y.append(s.distal.y - shift.y)
-            z.append(s.distal.z - shift.z)
-            diameter.append(s.distal.diameter)
-        return Section(n=len(section.segmentList), x=x * um, y=y * um, z=z * um,
-                       diameter=diameter * um)
+    # Returns the x, y, z coordinates (relative to the start point) and the
+    # diameter of the start point and all distal points of a section
+    def _section_points(self, section, section_parent):
+        shift = section.segmentList[0].proximal
+        start = (section_parent.segmentList[-1].distal if
+                 section_parent is not None else shift)
+        points = np.array([(shift.x, shift.y, shift.z, start.diameter)] +
+                          [(s.distal.x, s.distal.y, s.distal.z, s.distal.diameter)
+                           for s in section.segmentList], dtype=float)
+        points[:, :3] -= points[0, :3]
+        return points
 
     # Generate proximal points for a segment if not present already
     def _adjust_morph_object(self, segments):
         for segment in segments:
             if segment.proximal is None:
                 if segment.parent is not None:
-                    parent_seg = get_parent_segment(segment, segments)
+                    parent_seg = get_parent_segment(segment, self.seg_dict)
                     segment.proximal = parent_seg.distal
                 else:
                     raise ValueError(
@@ -422,12 +795,13 @@ class NMLMorphology(object):
 
     # Performs Depth-first traversal on segment node and its child segments
     def _perform_dfs(self, mapping, node, counter, children):
-        mapping[node] = counter
-        new_counter = counter + 1
-        for child in children[node]:
-            new_counter = self._perform_dfs(mapping, child, new_counter,
-                                            children)
-        return new_counter
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            mapping[node] = counter
+            counter += 1
+            stack.extend(reversed(children[node]))
+        return counter
 
     # Returns segment dictionary with each segment's id as key
     def _get_segment_dict(self, segments):
@@ -436,14 +810,22 @@ class NMLMorphology(object):
             segdict[s.id] = s
         return segdict
 
+    # Returns SegmentGroup dictionary with each group's id as key
+    def _get_group_dict(self, m):
+        return {g.id: g for g in m.segment_groups}
+
     # Returns SegmentGroup object corresponding to given group id.
     def _get_segment_group(self, m, grp_id):
+        if m is self.morph:
+            return self.group_dict.get(grp_id)
         for g in m.segment_groups:
             if g.id == grp_id:
                 return g
 
     # Returns parent/root segment object.
     def _get_root_segment(self, segments):
+        if segments is self.segments and getattr(self, 'root', None) is not None:
+            return self.root
         for x in segments:
             if x.parent is None:
                 return x
@@ -473,25 +855,17 @@ class NMLMorphology(object):
             Biophysical properties dictionary
         """
         prop = {}
-
-        def get_dict(obj_list):
-            d = {}
-            for o in obj_list:
-                d[o.segment_groups] = string_to_quantity(o.value)
-            return d
-
-        self.Ri = get_dict(bio_prop.intracellular_properties.resistivities)
-        self.Cm = get_dict(bio_prop.membrane_properties.specific_capacitances)
-        if len(bio_prop.membrane_properties.spike_threshes) == 1:
-            self.threshold = string_to_quantity(
-                bio_prop.membrane_properties.spike_threshes[0].value)
-            self.threshold_string = 'v > {}'.format(repr(self.threshold))
-            prop["threshold"] = self.threshold_string
-            prop["refractory"] = self.threshold_string
-        if len(self.Cm) == 1:
-            prop["Cm"] = self.Cm[list(self.Cm.keys())[0]]
-        if len(self.Ri) == 1:
-            prop["Ri"] = self.Ri[list(self.Ri.keys())[0]]
+        Ri = _get_group_values(bio_prop.intracellular_properties.resistivities)
+        Cm = _get_group_values(bio_prop.membrane_properties.specific_capacitances)
+        threshold = _get_threshold(bio_prop)
+        if threshold is not None:
+            threshold_string = 'v > {}'.format(repr(threshold))
+            prop["threshold"] = threshold_string
+            prop["refractory"] = threshold_string
+        if len(Cm) == 1:
+            prop["Cm"] = Cm[list(Cm.keys())[0]]
+        if len(Ri) == 1:
+            prop["Ri"] = Ri[list(Ri.keys())[0]]
 
         return prop
 
@@ -507,12 +881,49 @@ class NMLMorphology(object):
         name : str
             Name of the property that should be set.
         value_dict: dict
-            Dictionary of properties to be applied.
+            Dictionary of properties to be applied, mapping segment groups
+            to values. For compartments in several segment groups, the value
+            of the last group is used.
+        """
+        self._set_compartment_values(neuron,
+                                     {name: list(value_dict.items())})
+
+    def set_channel_properties(self, neuron):
+        """
+        Applies the conductance densities and reversal potentials of all
+        ion channels (see `channel_properties`) to the compartments of
+        the given SpatialNeuron.
+
+        Parameters
+        ----------
+        neuron: SpatialNeuron
+            SpatialNeuron object with equations for all the ion channels.
+        """
+        assignments = defaultdict(list)
+        for segment_group, values in self.channel_properties.items():
+            for name, value in values.items():
+                assignments[name].append((segment_group, value))
+        self._set_compartment_values(neuron, assignments)
+
+    def _set_compartment_values(self, neuron, assignments):
+        """
+        Sets the variables of *neuron* given by *assignments*, a dictionary
+        mapping variable names to lists of (segment group, value) pairs,
+        where later segment groups take precedence. The values of all
+        compartments are assembled in a single array and each variable is
+        set with a single assignment.
         """
-        for segment_group, value in value_dict.items():
-            ids = self.segment_groups[segment_group]
-            if len(ids):
-                getattr(neuron, name)[ids] = value
+        for name, group_values in assignments.items():
+            variable = getattr(neuron, name)
+            values = None
+            for segment_group, value in group_values:
+                ids = self.segment_groups[segment_group]
+                if len(ids):
+                    if values is None:
+                        values = variable[:].copy()
+                    values[ids] = value
+            if values is not None:
+                variable[:] = values
 
     def _get_channel_props(self, channels):
         """
@@ -531,11 +942,11 @@ class NMLMorphology(object):
             various channels
         """
         properties = defaultdict(dict)
-        for c in channels:
-            properties[c.segment_groups]['g_' + c.ion_channel] = string_to_quantity(
-                c.cond_density)
-            properties[c.segment_groups]['E_' + c.ion_channel] = string_to_quantity(
-                c.erev)
+        cond_densities = strings_to_quantity([c.cond_density for c in channels])
+        erevs = strings_to_quantity([c.erev for c in channels])
+        for c, cond_density, erev in zip(channels, cond_densities, erevs):
+            properties[c.segment_groups]['g_' + c.ion_channel] = cond_density
+            properties[c.segment_groups]['E_' + c.ion_channel] = erev
         return dict(properties)
 
     def get_channel_equations(self, ion_channel):
@@ -554,19 +965,15 @@ class NMLMorphology(object):
         Returns
         -------
         Equations
-            equation object for the given ion channel.
+            equation object for the given ion channel, only created once
+            for each ion channel.
         """
-        channel_obj = None
-        for c in itertools.chain(self.doc.ion_channel, self.doc.ion_channel_hhs):
-            if c.id == ion_channel:
-                channel_obj = c
-                break
+        if ion_channel in self._channel_equations:
+            return self._channel_equations[ion_channel]
+        channel_obj = self.ion_channels.get(ion_channel)
         if channel_obj is None:
             err = ("ion channel `{}` not found. List of ion channel present "
-                   "here:\n {}").format(ion_channel,
-                                        [c.id for c in
-                                         itertools.chain(getattr(self.doc, 'ion_channel', []),
-                                                         getattr(self.doc, 'ion_channel_hhs', []))])
+                   "here:\n {}").format(ion_channel, list(self.ion_channels))
             logger.error(err)
             raise ValueError(err)
 
@@ -680,4 +1087,5 @@ class NMLMorphology(object):
                                       "supports ion channels of type: `{}`".format(
                 channel_type, ['ionChannelPassive', 'ionChannelHH']))
 
+        self._channel_equations[ion_channel] = eq
         return eq
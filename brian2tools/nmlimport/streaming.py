@@ -0,0 +1,296 @@
+"""
+Streaming import of very large NeuroML morphologies, without creating the
+libNeuroML objects for all segments.
+"""
+import re
+from collections import defaultdict
+from xml.etree.ElementTree import iterparse
+
+import numpy as np
+
+from brian2tools.nmlutils.utils import string_to_quantity, strings_to_quantity
+from .nml import (MorphologyDescription, ValidationException,
+                  _resolve_segment_group, _to_brian_ids)
+
+__all__ = ['load_morphology_streaming']
+
+# Number of segments the arrays are initially allocated for
+INITIAL_SEGMENTS = 1024
+
+
+def _local_name(tag):
+    # strip the namespace, e.g. "{http://www.neuroml.org/...}segment"
+    return tag.rpartition('}')[2]
+
+
+def _point(elem):
+    return (float(elem.get('x')), float(elem.get('y')), float(elem.get('z')),
+            float(elem.get('diameter')))
+
+
+class _SegmentArrays(object):
+    """
+    Arrays of the ids, parent ids, proximal and distal points (x, y, z and
+    diameter) and name indices of all segments, growing as needed. Missing
+    proximal points are stored as NaN, missing parents as -1.
+    """
+
+    def __init__(self, size=INITIAL_SEGMENTS):
+        self.n = 0
+        self.ids = np.empty(size, dtype=np.int64)
+        self.parents = np.empty(size, dtype=np.int64)
+        self.proximal = np.empty((size, 4))
+        self.distal = np.empty((size, 4))
+        self.name_index = np.empty(size, dtype=np.int64)
+        self.names = []
+        self._name_indices = {}
+
+    def append(self, elem):
+        """
+        Stores the segment described by the XML element *elem*.
+        """
+        if self.n == len(self.ids):
+            for attr in ['ids', 'parents', 'proximal', 'distal', 'name_index']:
+                old = getattr(self, attr)
+                new = np.empty((2 * len(old), ) + old.shape[1:],
+                               dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, attr, new)
+        k = self.n
+        self.ids[k] = int(elem.get('id'))
+        self.parents[k] = -1
+        self.proximal[k] = np.nan
+        for child in elem:
+            tag = _local_name(child.tag)
+            if tag == 'parent':
+                self.parents[k] = int(child.get('segment'))
+                fraction_along = float(child.get('fractionAlong', 1))
+                if fraction_along not in [0, 1]:
+                    raise NotImplementedError(
+                        "Segment {0} has fraction along value {1} which is "
+                        "not supported!!".format(self.ids[k], fraction_along))
+            elif tag == 'proximal':
+                self.proximal[k] = _point(child)
+            elif tag == 'distal':
+                self.distal[k] = _point(child)
+        name = elem.get('name')
+        if name not in self._name_indices:
+            self._name_indices[name] = len(self.names)
+            self.names.append(name)
+        self.name_index[k] = self._name_indices[name]
+        self.n += 1
+
+    def name(self, k):
+        return self.names[self.name_index[k]]
+
+
+def _parse(filename):
+    """
+    Parses the first morphology and biophysical properties in the .nml file,
+    removing all processed segments and segment groups from the XML tree.
+    """
+    segments = _SegmentArrays()
+    groups = {}
+    bio = defaultdict(list)
+    state = {'morphology': None, 'biophysicalProperties': None}
+    stack = []
+    for event, elem in iterparse(filename, events=('start', 'end')):
+        tag = _local_name(elem.tag)
+        if event == 'start':
+            stack.append(elem)
+            if tag in state and state[tag] is None:
+                state[tag] = 'active'
+            continue
+        stack.pop()
+        if tag in state and state[tag] == 'active':
+            state[tag] = 'done'
+        elif state['morphology'] == 'active' and tag == 'segment':
+            segments.append(elem)
+        elif state['morphology'] == 'active' and tag == 'segmentGroup':
+            members, includes = [], []
+            for child in elem:
+                child_tag = _local_name(child.tag)
+                if child_tag == 'member':
+                    members.append(int(child.get('segment')))
+                elif child_tag == 'include':
+                    includes.append(child.get('segmentGroup'))
+            groups[elem.get('id')] = (members, includes)
+        elif (state['biophysicalProperties'] == 'active' and
+              tag in ('spikeThresh', 'specificCapacitance', 'resistivity',
+                      'channelDensity')):
+            bio[tag].append(dict(elem.attrib))
+            continue
+        else:
+            continue
+        # free the memory of the processed element
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+    return segments, groups, bio
+
+
+def _properties(bio):
+    """
+    Returns the biophysical properties and the channel properties from
+    the parsed attributes of the biophysical properties, like
+    `NMLMorphology.properties` and `NMLMorphology.channel_properties`.
+    """
+    prop = {}
+    if len(bio['spikeThresh']) == 1:
+        threshold = string_to_quantity(bio['spikeThresh'][0]['value'])
+        prop['threshold'] = 'v > {}'.format(repr(threshold))
+        prop['refractory'] = prop['threshold']
+    for tag, name in [('specificCapacitance', 'Cm'), ('resistivity', 'Ri')]:
+        values = dict(zip([attrs.get('segmentGroup', 'all') for attrs in bio[tag]],
+                          strings_to_quantity([attrs['value'] for attrs in bio[tag]])))
+        if len(values) == 1:
+            prop[name] = list(values.values())[0]
+    channel_properties = defaultdict(dict)
+    densities = bio['channelDensity']
+    cond_densities = strings_to_quantity([attrs['condDensity'] for attrs in densities])
+    erevs = strings_to_quantity([attrs['erev'] for attrs in densities])
+    for attrs, cond_density, erev in zip(densities, cond_densities, erevs):
+        channel = channel_properties[attrs.get('segmentGroup', 'all')]
+        channel['g_' + attrs['ionChannel']] = cond_density
+        channel['E_' + attrs['ionChannel']] = erev
+    return prop, dict(channel_properties)
+
+
+def load_morphology_streaming(filename, name_heuristic=True):
+    """
+    Imports the morphology from a .nml file, streaming the XML file instead
+    of loading it with libNeuroML. The segments are directly stored in NumPy
+    arrays, which needs much less memory for very large morphologies. Only
+    the first morphology and biophysical properties in the file are used,
+    included files are ignored, and the file is not validated.
+
+    Parameters
+    ----------
+    filename: str
+        nml file path or a file object
+    name_heuristic: bool
+        Whether to determine the sections from the segment names, see
+        `NMLMorphology`.
+
+    Returns
+    -------
+    MorphologyDescription
+        Description of the morphology, the resolved segment groups and the
+        biophysical properties, the same as the one returned by
+        `NMLMorphology.describe`.
+    """
+    segments, groups, bio = _parse(filename)
+    n = segments.n
+    if n == 0:
+        raise ValueError("No segments found in `{}`".format(filename))
+    ids = segments.ids[:n]
+    parents = segments.parents[:n]
+    proximal = segments.proximal[:n]
+    distal = segments.distal[:n]
+
+    # index of the parent of each segment in the arrays
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    if np.any(np.diff(sorted_ids) == 0):
+        raise ValueError("Segment ids are not unique")
+    roots = np.flatnonzero(parents == -1)
+    if len(roots) != 1:
+        raise ValidationException("Expected a single segment without "
+                                  "parent, found {}".format(list(ids[roots])))
+    root = roots[0]
+    has_parent = parents != -1
+    positions = np.searchsorted(sorted_ids, parents[has_parent])
+    positions = np.minimum(positions, n - 1)
+    if np.any(sorted_ids[positions] != parents[has_parent]):
+        raise ValueError("Segments refer to unknown parent segments")
+    parent_index = np.full(n, -1)
+    parent_index[has_parent] = order[positions]
+
+    # take missing proximal points from the parent segment
+    missing = np.isnan(proximal[:, 0])
+    if missing[root]:
+        raise ValueError("Segment {0} has no parent and no proximal "
+                         "point".format(ids[root]))
+    proximal[missing] = distal[parent_index[missing]]
+
+    # children of each segment, in the order of the file
+    children = np.flatnonzero(has_parent)
+    children = children[np.argsort(parent_index[children], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(np.bincount(parent_index[has_parent],
+                                                        minlength=n))])
+
+    # section tree, following the same rules as NMLMorphology._create_tree
+    section_names, section_parents, section_segments = ['soma'], [-1], [[]]
+    incremental_id = 0
+
+    def initialize_section(parent, k):
+        nonlocal incremental_id
+        if name_heuristic:
+            name = segments.name(k)
+        else:
+            incremental_id += 1
+            name = 'sec' + str(incremental_id)
+        section_names.append(name)
+        section_parents.append(parent)
+        section_segments.append([])
+        return len(section_names) - 1
+
+    stack = [(0, None, root)]
+    while stack:
+        section, name_k, k = stack.pop()
+        if name_k is not None:
+            section = initialize_section(section, name_k)
+        while k is not None:
+            section_segments[section].append(k)
+            seg_children = children[starts[k]:starts[k + 1]]
+            if len(seg_children) > 1 or segments.name(k) == 'soma':
+                stack.extend((section, c, c) for c in seg_children[::-1])
+                k = None
+            elif len(seg_children) == 1:
+                child = seg_children[0]
+                if name_heuristic:
+                    root_name = section_names[section].rstrip('0123456789_')
+                    if not segments.name(child).startswith(root_name):
+                        section = initialize_section(section, k)
+                    else:
+                        # separate integer from the end of segment name
+                        m = re.search(r'\d+$', segments.name(child))
+                        section_names[section] = '{}_{}'.format(
+                            section_names[section], m.group())
+                k = child
+            else:
+                k = None
+
+    section_points = []
+    for section, segs in enumerate(section_segments):
+        segs = np.asarray(segs)
+        parent = section_parents[section]
+        points = np.empty((len(segs) + 1, 4))
+        points[0, :3] = proximal[segs[0], :3]
+        points[0, 3] = (distal[section_segments[parent][-1], 3]
+                        if parent >= 0 else proximal[segs[0], 3])
+        points[1:] = distal[segs]
+        points[:, :3] -= points[0, :3]
+        section_points.append(points)
+
+    # compartment indices in depth-first order of the segments
+    brian_index = np.empty(n, dtype=int)
+    counter = 0
+    stack = [root]
+    while stack:
+        k = stack.pop()
+        brian_index[k] = counter
+        counter += 1
+        stack.extend(children[starts[k]:starts[k + 1]][::-1])
+    segment_groups = {}
+    resolved = {}
+    for group_id in groups:
+        grp_ids = _resolve_segment_group(group_id, groups.get, resolved)
+        segment_groups[group_id] = _to_brian_ids(group_id, grp_ids, sorted_ids,
+                                                 brian_index[order])
+
+    properties, channel_properties = _properties(bio)
+    return MorphologyDescription(section_names,
+                                 np.array(section_parents, dtype=int),
+                                 section_points, segment_groups, properties,
+                                 channel_properties)
@@ -1,64 +1,93 @@
 import re
+from functools import lru_cache
 
+import numpy as np
 from brian2.units.allunits import all_units
+from brian2.units.fundamentalunits import (Quantity, DimensionMismatchError,
+                                           get_dimensions)
 
 
 name_to_unit = {u.dispname: u for u in all_units}
 
+# A value followed by an optional unit, e.g. "1.2e-4 mV", "10pS",
+# "0.2 kohm_cm" or "1.28e3per_s"
+_QUANTITY = re.compile(r'\s*(-?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)'
+                       r'\s*(.*?)\s*$')
+# A single unit with an optional exponent, e.g. "mV", "cm2" or "m-2"
+_UNIT = re.compile(r'([a-zA-Z]+)(-?[0-9]+)?$')
+# Separator between the units of a product, e.g. "kohm_cm" or "uF_per_cm2"
+_UNIT_SEPARATOR = re.compile(r'[_\s]+')
+# Number of parsed units and values kept in the caches
+PARSE_CACHE_SIZE = 4096
 
-def from_string(rep):
+
+def _single_unit(rep):
     """
-    Returns `Quantity` object from text representation of a value.
+    Returns the Brian unit for a single unit with an optional exponent.
+    """
+    m = _UNIT.match(rep)
+    if m is None:
+        raise ValueError("Cannot parse unit `{}`".format(rep))
+    name, exponent = m.groups()
+    if name not in name_to_unit:
+        raise ValueError("Unknown unit `{}`".format(name))
+    if exponent is None:
+        return name_to_unit[name]
+    # use Brian's predefined powers of units (e.g. cm^2) where available
+    power = '{}^{}'.format(name, exponent)
+    if power in name_to_unit:
+        return name_to_unit[power]
+    return name_to_unit[name] ** int(exponent)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_unit(rep):
+    """
+    Returns the Brian unit for the text representation of a unit (e.g.
+    "uF_per_cm2"), as a (numerator, denominator) tuple where each entry is
+    either a unit or None.
+    """
+    numerator, denominator = None, None
+    in_denominator = False
+    for part in _UNIT_SEPARATOR.split(rep):
+        if not part:
+            continue
+        if part == 'per':
+            if in_denominator:
+                raise ValueError("value `{}` has more than one `per` "
+                                 "statement!!".format(rep))
+            in_denominator = True
+            continue
+        unit = _single_unit(part)
+        if in_denominator:
+            denominator = unit if denominator is None else denominator * unit
+        else:
+            numerator = unit if numerator is None else numerator * unit
+    return numerator, denominator
 
-    Parameters
-    ----------
-    rep : `str`
-        text representation of a value with unit
 
-    Returns
-    -------
-    q : `Quantity`
-        Brian Quantity object
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_quantity(rep):
+    """
+    Splits the text representation of a value into its numerical value and
+    its unit string.
     """
+    m = _QUANTITY.match(rep)
+    if m is None:
+        raise ValueError("Cannot parse value `{}`".format(rep))
+    value, unit = m.groups()
+    return float(value), unit
 
-    # match value
-    m = re.match('-?[0-9]+\.?([0-9]+)?[eE]?-?([0-9]+)?', rep)
-    if m:
-        value = rep[0:m.end()]
-        rep = rep[m.end():]
-    else:
-        raise ValueError("Empty value given")
-
-    # match unit
-    m = re.match(' ?([a-zA-Z]+)', rep)
-    unit = None
-    per = None
-    if m:
-        unit = rep[0:m.end()].strip()
-
-        # special case with per
-        if unit == 'per':
-            mper = re.match(' ?per_([a-zA-Z]+)', rep)
-            per = rep[0:mper.end()].strip()[4:]
-            m = mper
-        rep = rep[m.end():]
-
-    # match exponent
-    m = re.match('-?([0-9]+)?', rep)
-    exponent = None
-    if len(rep) > 0 and m:
-        exponent = rep[0:m.end()]
-    if unit:
-        if per:
-            b2unit = 1. / name_to_unit[per]
-        else:
-            b2unit = name_to_unit[unit]
-        if value and exponent:
-            return float(value) * b2unit**float(exponent)
-        elif value:
-            return float(value) * b2unit
-    else:
-        return float(value)
+
+def _with_unit(value, unit):
+    numerator, denominator = _parse_unit(unit)
+    if numerator is not None:
+        if denominator is not None:
+            return value * (numerator / denominator)
+        return value * numerator
+    if denominator is not None:
+        return value / denominator
+    return value
 
 
 def string_to_quantity(rep):
@@ -75,46 +104,53 @@ def string_to_quantity(rep):
         q : `Quantity`
             Brian Quantity object
     """
+    return _with_unit(*_parse_quantity(rep))
+
+
+def strings_to_quantity(reps):
+    """
+    Returns a single `Quantity` array from the text representations of
+    several values, e.g. all values of a property in a .nml file.
+
+    Parameters
+    ----------
+    reps : list of `str`
+        text representations of values with units of the same dimensions
+
+    Returns
+    -------
+    q : `Quantity`
+        Brian Quantity array
+    """
+    parsed = [_parse_quantity(rep) for rep in reps]
+    values = np.array([value for value, _ in parsed], dtype=float)
+    units = {unit for _, unit in parsed}
+    if len(units) <= 1:
+        # all values share their unit
+        return _with_unit(values, units.pop() if units else '')
+    # convert all values to base units
+    scales = {unit: _with_unit(1.0, unit) for unit in units}
+    dimensions = {get_dimensions(scale) for scale in scales.values()}
+    if len(dimensions) > 1:
+        raise DimensionMismatchError("Values have different "
+                                     "dimensions", *dimensions)
+    factors = np.array([float(np.asarray(scales[unit]))
+                        for _, unit in parsed])
+    return Quantity(values * factors, dim=dimensions.pop())
+
+
+def from_string(rep):
+    """
+    Returns `Quantity` object from text representation of a value.
+
+    Parameters
+    ----------
+    rep : `str`
+        text representation of a value with unit
 
-    pre,post=None,None
-    quant=rep.split("per")
-    quant=[a.strip('_') for a in quant]
-    if len(quant)<2:
-        pre = quant[0]
-    elif len(quant)==2:
-        pre,post=quant
-    else:
-        raise ValueError("value `{}` hae more than one `per` "
-                         "statement!!".format(rep))
-    m = re.match('-?[0-9]+\.?([0-9]+)?[eE]?-?([0-9]+)?', pre)
-    if m:
-        value = pre[0:m.end()]
-        pre = pre[m.end():]
-    numerator = None
-    deno = None
-
-    if pre is not None:
-        for u in pre.strip().split("_"):
-            m = re.search(r'\d+$', u)
-            if m:
-                u = u[:m.start()] + '^' + u[m.start():]
-            if u:
-                numerator = name_to_unit[u] if numerator is None else numerator * \
-                                                                  name_to_unit[u]
-
-    if post is not None:
-        for u in post.strip().split("_"):
-            m = re.search(r'\d+$', u)
-            if m:
-                u = u[:m.start()] + '^' + u[m.start():]
-            if u:
-                deno = name_to_unit[u] if deno is None else deno * name_to_unit[u]
-
-    if numerator:
-        if deno:
-            return float(value) * (numerator / deno)
-        return float(value) * numerator
-    else:
-        if deno:
-            return float(value) / deno
-        return float(value)
+    Returns
+    -------
+    q : `Quantity`
+        Brian Quantity object
+    """
+    return string_to_quantity(rep)
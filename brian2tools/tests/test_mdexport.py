@@ -3,6 +3,7 @@ Test cases to check `mdexport` package
 """
 import re
 
+import numpy as np
 import pytest
 from brian2 import (
     Equations,
@@ -100,6 +101,12 @@ def test_simple_syntax():
     net.run(0.01 * ms)
     md_str = device.md_text
     assert _markdown_lint(md_str)
+    assert 'Variable $v$' in md_str
+    # the collected dictionaries are not changed by the expander
+    components = device.runs[0]['components']
+    assert 'initializer' not in components['neurongroup'][0]
+    assert 'initializer' not in components['synapses'][0]
+    assert 'connectors' not in components['synapses'][0]
     check = 'randn({sin({$w$}|$v_rest$ - $v$|/{\tau}})})'
     assert _markdown_lint(check)
     # check invalid strings
@@ -290,6 +297,8 @@ def test_user_options():
     """
     link = '<img src="https://render.githubusercontent.com/render/math?math='
     my_expander = MdExpander(github_md=True, author='Brian', add_meta=True)
+    # the source file is looked up from the caller of the constructor
+    assert my_expander.user_file == __file__
     set_device('markdown', expander=my_expander)
     grp = NeuronGroup(1, 'w :1')
     run(0*ms)
@@ -316,6 +325,126 @@ def test_user_options():
     device.reinit()
 
 
+def test_prepare_array():
+    """
+    Test summarized arrays and summary statistics
+    """
+    expander = MdExpander()
+    print_options = np.get_printoptions()
+    assert expander.prepare_array([0, 1, 2]) == '[0 1 2]'
+    assert expander.prepare_array(np.arange(100)) == '[ 0  1  2 ... 97 98 99]'
+    assert (expander.prepare_array(np.arange(100) * ms) ==
+            '[ 0.  1.  2. ... 97. 98. 99.] ms')
+    assert expander.prepare_array(np.ones((20, 20))).count('...') == 7
+    assert expander.prepare_array(5 * ms) == '5. ms'
+    # the unit is chosen for the shown values only
+    assert (expander.prepare_array(np.arange(1000) * Hz) ==
+            '[  0.   1.   2. ... 997. 998. 999.] Hz')
+    widespread = np.r_[np.arange(1, 501), 1e6 * np.arange(1, 501)] * ms
+    assert (expander.prepare_array(widespread) ==
+            '[1.00e-03 2.00e-03 3.00e-03 ... 4.98e+05 4.99e+05 5.00e+05] s')
+    assert np.get_printoptions() == print_options
+
+    summary = expander.summarize_array(array([3, 1, 1, 2]) * mV)
+    assert summary['size'] == 4
+    assert summary['min'] == 1 * mV
+    assert summary['max'] == 3 * mV
+    assert summary['mean'] == 1.75 * mV
+    assert summary['unique'] == 3
+    assert expander.summarize_array([]) == {'size': 0}
+
+
+def test_array_summary():
+    """
+    Test summary statistics of large arrays in the generated markdown
+    """
+    set_device('markdown')
+    group = NeuronGroup(100, 'v : volt', name='group')
+    group.v = np.arange(100) * mV
+    spikegen = SpikeGeneratorGroup(100, np.arange(100), np.arange(100) * ms,
+                                   name='spikegen')
+    short_spikegen = SpikeGeneratorGroup(3, [0, 1, 2], [1, 2, 3] * ms,
+                                         name='short_spikegen')
+    run(0 * ms)
+    md_str = device.md_text
+    assert '(100 values from 0 to 99 with mean 49.5, 100 unique)' in md_str
+    assert ('(100 values from 0. s to 0.099 s with mean 0.0495 s, '
+            '100 unique)') in md_str
+    assert 'with mean 49.5 mV, 100 unique)' in md_str
+    # short arrays are shown completely, without a summary
+    assert md_str.count('unique)') == 3
+    device.reinit()
+
+
+def test_incremental_build(tmp_path):
+    """
+    Test that unchanged models and components are not rendered again
+    """
+    class CountingExpander(MdExpander):
+        def __init__(self):
+            super(CountingExpander, self).__init__()
+            self.expanded = []
+
+        def expand_group(self, group, template_name):
+            self.expanded.append(group['name'])
+            return super(CountingExpander, self).expand_group(group,
+                                                              template_name)
+
+    filename = str(tmp_path / 'model')
+    md_texts = []
+    # only the group using tau changes in the last build
+    expected_expanded = [['group1', 'group2'], [], ['group1']]
+    for tau, expected in zip([10*ms, 10*ms, 20*ms], expected_expanded):
+        expander = CountingExpander()
+        set_device('markdown', filename=filename, expander=expander)
+        group1 = NeuronGroup(1, 'dv/dt = -v/tau : 1', name='group1')
+        group2 = NeuronGroup(1, 'dv/dt = -v/(10*ms) : 1', name='group2')
+        run(0*ms)
+        md_texts.append(device.md_text)
+        device.reinit()
+        assert sorted(expander.expanded) == expected
+    assert md_texts[0] == md_texts[1]
+    assert md_texts[0] != md_texts[2]
+    with open(filename + '.md') as f:
+        assert f.read() == md_texts[2]
+
+
+def test_additional_formats(tmp_path, monkeypatch):
+    """
+    Test that conversions are skipped when the markdown text did not change
+    """
+    conversions = []
+
+    def fake_pandoc(source_file, format_name, filename):
+        conversions.append(format_name)
+        with open(filename, 'w') as f:
+            f.write(format_name)
+
+    monkeypatch.setattr(mdexport.mdexporter, '_pandoc_available', lambda: True)
+    monkeypatch.setattr(mdexport.mdexporter, '_run_pandoc', fake_pandoc)
+    filename = str(tmp_path / 'model')
+    for _ in range(2):
+        set_device('markdown', filename=filename, additional_formats='all')
+        grp = NeuronGroup(1, 'w :1', name='grp')
+        run(0*ms)
+        device.reinit()
+    assert sorted(conversions) == ['html', 'latex', 'pdf']
+    for ext in ['.md', '.tex', '.html', '.pdf']:
+        assert (tmp_path / ('model' + ext)).exists()
+
+    # No conversion, no need for pandoc
+    monkeypatch.setattr(mdexport.mdexporter, '_pandoc_available', lambda: False)
+    set_device('markdown', filename=filename)
+    grp = NeuronGroup(1, 'w :1', name='grp')
+    run(0*ms)
+    device.reinit()
+    set_device('markdown', filename=filename, additional_formats='html')
+    grp = NeuronGroup(1, 'w :1', name='grp')
+    with pytest.raises(Exception, match='Pandoc is not installed'):
+        run(0*ms)
+    device.reinit()
+
+
 if __name__ == '__main__':
 
     test_simple_syntax()
@@ -1,5 +1,8 @@
+import gzip
+import os
 import tempfile
 from subprocess import call
+from xml.etree.ElementTree import canonicalize
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -7,9 +10,18 @@ from numpy.testing import assert_allclose, assert_equal
 from pytest import mark, raises
 # We avoid "from brian2 import *", as this would also import Brian's test
 # function which will then be collected by py.test
-from brian2 import set_device, NeuronGroup, StateMonitor, SpikeMonitor, run
+from brian2 import (set_device, device, NeuronGroup, StateMonitor,
+                    SpikeMonitor, Synapses, run)
 from brian2 import second, mV, amp, metre, psiemens, ms
+from brian2.parsing.rendering import NodeRenderer
+from brian2.utils.logger import catch_logs
 
+from brian2tools.nmlexport import batch_export
+from brian2tools.nmlexport.lemsexport import (NMLExporter, make_lems_unit,
+                                              _determine_dimension,
+                                              _multiinstantiate_expression,
+                                              _connections)
+from brian2tools.nmlexport.lemsrendering import LEMSRenderer, _render_expr
 from brian2tools.nmlexport.supporting import *
 from brian2tools.nmlutils.utils import from_string
 
@@ -121,6 +133,52 @@ def test_brian_unit_to_lems():
     assert_equal(brian_unit_to_lems(0*ms), "0")
 
 
+def test_lems_dimensions_and_units():
+    assert _determine_dimension(10*ms) == 'time'
+    assert _determine_dimension(mV) == 'voltage'
+    assert _determine_dimension(psiemens) == 'conductance'
+    assert _determine_dimension(1) == 'none'
+    unit = make_lems_unit(mV)
+    assert (unit.symbol, unit.dimension) == ('mV', 'voltage')
+    assert make_lems_unit(mV) is not unit
+    exporter = NMLExporter()
+    for value, expected in [(10*ms, '10. ms'), (0.5*ms, '0.5 ms'),
+                            (10*ms, '10. ms'), (-65*mV, '-65. mV'),
+                            (3, '3')]:
+        assert exporter._unit_lems_validator(value) == expected
+
+
+def test_multiinstantiate_expression():
+    assert _multiinstantiate_expression('20*mV * i / (N-1)') == \
+           ('20*mVconst * index / (N-1)', ('mV', ))
+    assert _multiinstantiate_expression('i*ms+exp(-i/1e3)*ms - v_i*mV') == \
+           ('index*msconst+exp(-index/1e3)*msconst - v_i*mVconst', ('ms', 'mV'))
+    assert _multiinstantiate_expression('2.5e-3*V') == \
+           ('2.5e-3*Vconst', ('V', ))
+
+
+def test_lems_renderer_cache():
+    renderer = LEMSRenderer()
+    expr = 'v > 10*mV and not (x <= exp(-t/tau))'
+    expected = NodeRenderer.render_expr(renderer, expr)
+    assert renderer.render_expr(expr) == expected
+    hits = _render_expr.cache_info().hits
+    # the cache is shared between renderers of the same class
+    assert LEMSRenderer().render_expr(expr) == expected
+    assert _render_expr.cache_info().hits == hits + 1
+    with raises(ValueError):
+        renderer.render_expr('clip(v, 0, 1)')
+
+    # but not with subclasses
+    class UpperCaseRenderer(LEMSRenderer):
+        def render_func(self, node):
+            return super(UpperCaseRenderer, self).render_func(node).upper()
+
+    assert UpperCaseRenderer().render_expr(expr) == expected.replace('exp',
+                                                                     'EXP')
+    assert renderer.render_expr(expr) == expected
+
+
 def test_neuromlsimulation():
     nmlsim = NeuroMLSimulation('a', 'b')
     with raises(AssertionError):
@@ -179,6 +237,26 @@ def test_neuromlsimulation():
         assert event_selection.getAttributeNode(k).value == v
 
 
+def test_neuromlsimulation_eventselections():
+    nmlsim = NeuroMLSimulation('a', 'b')
+    with raises(AssertionError):
+        nmlsim.add_eventselections('pop', [1, 2])
+    nmlsim.add_eventoutputfile('eof1')
+    nmlsim.add_eventselections('pop', np.array([2, 7, 11]))
+    nmlsim.add_eventselections('pop', [], event_port='custom')
+    xml = nmlsim.build()
+    event_output = xml.childNodes[0]
+    assert event_output.tagName == 'EventOutputFile'
+    selections = event_output.childNodes
+    assert len(selections) == 3
+    for i, selection in zip([2, 7, 11], selections):
+        assert selection.tagName == 'EventSelection'
+        for k, v in [("id", "line{}".format(i)),
+                     ("select", "pop[{}]".format(i)),
+                     ("eventPort", "spike")]:
+            assert selection.getAttributeNode(k).value == v
+
+
 def test_simplenetwork():
     nmlnet = NeuroMLSimpleNetwork("net")
     nmlnet.add_component("i0", "lf", a=3, b=4)
@@ -191,3 +269,363 @@ def test_simplenetwork():
     assert child.tagName == 'Component'
     for k, v in [('a', "3"), ('b', "4"), ('id', "i0"), ('type', "lf")]:
         assert child.getAttributeNode(k).value == v
+
+
+def test_export_to_file(tmp_path):
+    set_device('neuroml2', filename=str(tmp_path / LEMS_OUTPUT_FILENAME),
+               build_on_run=False)
+    tau = 10*ms
+    group = NeuronGroup(10, 'dv/dt = (v0 - v) / tau : volt (unless refractory)\n'
+                            'v0 : volt', threshold='v > 10*mV',
+                        reset='v = 0*mV', refractory=5*ms, method='linear')
+    group.v0 = '20*mV * i / (N-1)'
+    state_mon = StateMonitor(group, 'v', record=True)
+    spike_mon = SpikeMonitor(group)
+    run(10*ms)
+    exporter = NMLExporter()
+    exporter.create_lems_model(device.runs, recordingsname='recording')
+    expected = canonicalize(exporter.model.toprettyxml("  ", "\n"),
+                            strip_text=True)
+    for compress in [False, True]:
+        filename = str(tmp_path / 'model')
+        exporter.export_to_file(filename, compress=compress)
+        if compress:
+            with gzip.open(filename + '.xml.gz', 'rt') as f:
+                xml = f.read()
+        else:
+            with open(filename + '.xml') as f:
+                xml = f.read()
+        assert canonicalize(xml, strip_text=True) == expected
+
+
+def test_statemonitor_columns_per_file():
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    tau = 10*ms
+    group = NeuronGroup(5, 'dv/dt = (v0 - v) / tau : volt\n'
+                           'v0 : volt', threshold='v > 10*mV',
+                        reset='v = 0*mV', method='linear')
+    mon = StateMonitor(group, ['v', 'v0'], record=True)
+    run(10*ms)
+    exporter = NMLExporter()
+    exporter.create_lems_model(device.runs, recordingsname='recording',
+                               columns_per_file=2)
+    population = exporter._model_namespace['populationname']
+    simulation = exporter.model.getElementsByTagName('Simulation')[0]
+    displays = simulation.getElementsByTagName('Display')
+    assert len(displays) == 2
+    for display, var in zip(displays, ['v', 'v0']):
+        lines = display.getElementsByTagName('Line')
+        assert [line.getAttribute('id') for line in lines] == \
+               ['line{}'.format(i) for i in range(5)]
+        assert [line.getAttribute('quantity') for line in lines] == \
+               ['{}[{}]/{}'.format(population, i, var) for i in range(5)]
+    output_files = simulation.getElementsByTagName('OutputFile')
+    assert [of.getAttribute('id') for of in output_files] == \
+           ['of0_0', 'of0_1', 'of0_2', 'of1_0', 'of1_1', 'of1_2']
+    assert [of.getAttribute('fileName') for of in output_files] == \
+           ['recording_{}_{}.dat'.format(var, c)
+            for var in ['v', 'v0'] for c in range(3)]
+    columns = [[column.getAttribute('quantity')
+                for column in of.getElementsByTagName('OutputColumn')]
+               for of in output_files]
+    assert columns[1] == ['{}[2]/v'.format(population),
+                          '{}[3]/v'.format(population)]
+    assert columns[5] == ['{}[4]/v0'.format(population)]
+
+
+def test_multiple_runs_and_groups():
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    tau = 10*ms
+    eqs = 'dv/dt = (v0 - v) / tau : volt\nv0 : volt'
+    group1 = NeuronGroup(5, eqs, threshold='v > 10*mV', reset='v = 0*mV',
+                         method='linear', name='group1')
+    group2 = NeuronGroup(3, eqs, threshold='v > 10*mV', reset='v = 0*mV',
+                         method='linear', name='group2')
+    group1.v0 = '20*mV * i / (N-1)'
+    mon1 = StateMonitor(group1, 'v', record=[0, 4], name='mon1')
+    mon2 = StateMonitor(group2[1:], 'v', record=[0], name='mon2')
+    spike_mon = SpikeMonitor(group2, name='spike_mon')
+    for _ in range(10):
+        run(10*ms)
+    assert len(device.runs) == 10
+    exporter = NMLExporter()
+    exporter.create_lems_model(device.runs, recordingsname='recording')
+    model = exporter.model
+    # each group is only defined once
+    component_types = [ct.getAttribute('name')
+                       for ct in model.getElementsByTagName('ComponentType')]
+    assert component_types == ['group1', 'group1Multi',
+                               'group2', 'group2Multi']
+    networks = model.getElementsByTagName('network')
+    assert len(networks) == 1
+    assert networks[0].getAttribute('id') == 'group1MultiNet'
+    assert [c.getAttribute('id')
+            for c in networks[0].getElementsByTagName('Component')] == \
+           ['group1Multipop', 'group2Multipop']
+    simulation = model.getElementsByTagName('Simulation')[0]
+    assert simulation.getAttribute('target') == 'group1MultiNet'
+    assert float(simulation.getAttribute('length').split()[0]) == 100
+    assert [d.getAttribute('id')
+            for d in simulation.getElementsByTagName('Display')] == \
+           ['disp0', 'disp1']
+    output_files = simulation.getElementsByTagName('OutputFile')
+    assert [of.getAttribute('fileName') for of in output_files] == \
+           ['recording_mon1.dat', 'recording_mon2.dat']
+    assert [c.getAttribute('quantity')
+            for c in output_files[1].getElementsByTagName('OutputColumn')] == \
+           ['group2Multipop[1]/v']
+    event_files = simulation.getElementsByTagName('EventOutputFile')
+    assert len(event_files) == 1
+    assert event_files[0].getAttribute('fileName') == 'recording.spikes'
+    assert [s.getAttribute('select')
+            for s in event_files[0].getElementsByTagName('EventSelection')] == \
+           ['group2Multipop[{}]'.format(i) for i in range(3)]
+
+
+def test_single_neuron_group():
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    eqs = 'dv/dt = -v / (10*ms) : volt'
+    multi = NeuronGroup(4, eqs, threshold='v > 10*mV', reset='v = 0*mV',
+                        method='exact', name='multi')
+    single = NeuronGroup(1, eqs, threshold='v > 10*mV', reset='v = 0*mV',
+                         method='exact', name='single')
+    state_mon = StateMonitor(single, 'v', record=True, name='state_mon')
+    spike_mon = SpikeMonitor(single, name='spike_mon')
+    run(10*ms)
+    exporter = NMLExporter()
+    exporter.create_lems_model(device.runs, recordingsname='recording')
+    model = exporter.model
+    # a group of a single neuron is a population of the network as well
+    network = model.getElementsByTagName('network')[0]
+    assert [c.getAttribute('id')
+            for c in network.getElementsByTagName('Component')] == \
+           ['multiMultipop', 'singleMultipop']
+    simulation = model.getElementsByTagName('Simulation')[0]
+    assert [c.getAttribute('quantity')
+            for c in simulation.getElementsByTagName('OutputColumn')] == \
+           ['singleMultipop[0]/v']
+    assert [s.getAttribute('select')
+            for s in simulation.getElementsByTagName('EventSelection')] == \
+           ['singleMultipop[0]']
+
+
+BATCH_SCRIPT = """
+from brian2 import *
+import brian2tools.nmlexport
+
+set_device('neuroml2', filename='ignored.xml')
+tau = 10*ms
+group = NeuronGroup(5, 'dv/dt = -v / tau : volt', threshold='v > 10*mV',
+                    reset='v = 0*mV', method='linear')
+mon = SpikeMonitor(group)
+run(10*ms)
+"""
+
+
+@mark.parametrize('workers', [1, 2])
+def test_batch_export(tmp_path, workers):
+    script = tmp_path / 'script_model.py'
+    script.write_text(BATCH_SCRIPT)
+    failing_script = tmp_path / 'failing_model.py'
+    failing_script.write_text('raise ValueError("broken model")\n')
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    tau = 10*ms
+    group = NeuronGroup(5, 'dv/dt = -v / tau : volt', threshold='v > 10*mV',
+                        reset='v = 0*mV', method='linear')
+    run(10*ms)
+    outdir = tmp_path / 'out'
+    results = batch_export([str(script), device.runs, str(failing_script)],
+                           str(outdir), workers=workers)
+    assert [r['name'] for r in results] == ['script_model', 'model1',
+                                            'failing_model']
+    for result in results[:2]:
+        assert result['error'] is None
+        assert result['time'] >= 0
+        assert os.path.exists(result['filename'])
+    assert 'broken model' in results[2]['error']
+    assert sorted(os.listdir(outdir)) == ['LEMSUnitsConstants.xml',
+                                          'model1.xml', 'script_model.xml']
+    assert not os.path.exists('ignored.xml')
+    with raises(ValueError):
+        batch_export([str(script), str(script)], str(outdir))
+
+
+def test_per_neuron_values(tmp_path):
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    tau = 10*ms
+    group = NeuronGroup(4, 'dv/dt = (v0 - v) / tau : volt\nv0 : volt',
+                        threshold='v > 10*mV', reset='v = 0*mV',
+                        method='linear', name='group')
+    group.v0 = np.array([1, 2, 3, 4])*mV
+    group.v = -70*mV
+    group.v[1:3] = -60*mV
+    run(10*ms)
+    exporter = NMLExporter()
+    exporter.create_lems_model(device.runs, recordingsname='recording')
+    model = exporter.model
+    cell = [ct for ct in model.getElementsByTagName('ComponentType')
+            if ct.getAttribute('name') == 'group'][0]
+    assert sorted(p.getAttribute('name')
+                  for p in cell.getElementsByTagName('Property')) == \
+           ['tau', 'v0', 'v_init']
+    assignments = cell.getElementsByTagName('OnStart')[0].getElementsByTagName('StateAssignment')
+    assert [(a.getAttribute('variable'), a.getAttribute('value'))
+            for a in assignments] == [('v', 'v_init')]
+    population = [ct for ct in model.getElementsByTagName('ComponentType')
+                  if ct.getAttribute('name') == 'groupMulti'][0]
+    assert [t.getAttribute('name')
+            for t in population.getElementsByTagName('Text')] == ['parameterFile']
+    filename = exporter.export_to_file(str(tmp_path / 'model'))
+    component = exporter.model.getElementsByTagName('network')[0].getElementsByTagName('Component')[0]
+    parameter_file = tmp_path / component.getAttribute('parameterFile')
+    assert parameter_file.name == 'model_groupMultipop.dat'
+    with open(parameter_file) as f:
+        header = f.readline()
+    values = np.loadtxt(parameter_file)
+    columns = header.strip('# \n').split()
+    assert sorted(columns) == ['v0', 'v_init']
+    assert_allclose(values[:, columns.index('v0')], [0.001, 0.002, 0.003, 0.004])
+    assert_allclose(values[:, columns.index('v_init')], [-0.07, -0.06, -0.06, -0.07])
+
+
+def test_per_neuron_values_conditions_and_subgroups(tmp_path):
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    tau = 10*ms
+    v_offset = 2*mV
+    group = NeuronGroup(6, 'dv/dt = (v0 - v) / tau : volt\nv0 : volt',
+                        threshold='v > 10*mV', reset='v = 0*mV',
+                        method='linear', name='group')
+    group.v0['i > 3'] = 5*mV
+    # references to the subgroups are kept until the end of the run
+    subgroup1, subgroup2 = group[1:3], group[2:5]
+    subgroup1.v0 = 7*mV
+    group.v = -70*mV
+    subgroup2.v['i > 0'] = 'v_offset * i'
+    run(10*ms)
+    exporter = NMLExporter()
+    exporter.create_lems_model(device.runs, recordingsname='recording')
+    cell = [ct for ct in exporter.model.getElementsByTagName('ComponentType')
+            if ct.getAttribute('name') == 'group'][0]
+    # no assignment to all neurons, only the per-neuron initial values
+    assignments = cell.getElementsByTagName('OnStart')[0].getElementsByTagName('StateAssignment')
+    assert [(a.getAttribute('variable'), a.getAttribute('value'))
+            for a in assignments] == [('v', 'v_init')]
+    exporter.export_to_file(str(tmp_path / 'model'))
+    parameter_file = tmp_path / 'model_groupMultipop.dat'
+    with open(parameter_file) as f:
+        columns = f.readline().strip('# \n').split()
+    values = np.loadtxt(parameter_file)
+    assert_allclose(values[:, columns.index('v0')],
+                    [0, 0.007, 0.007, 0, 0.005, 0.005])
+    assert_allclose(values[:, columns.index('v_init')],
+                    [-0.07, -0.07, -0.07, 0.002, 0.004, -0.07])
+
+
+def test_per_neuron_values_not_supported():
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    group = NeuronGroup(6, 'v : volt', name='group')
+    group.v['i > 3'] = 'rand() * mV'
+    run(10*ms)
+    exporter = NMLExporter()
+    with raises(NotImplementedError, match='rand'):
+        exporter.create_lems_model(device.runs, recordingsname='recording')
+
+
+def test_connections_chunks():
+    def connections(connectors, source_size, target_size, chunk_size):
+        chunks = list(_connections(connectors, source_size, target_size,
+                                   chunk_size))
+        assert all(len(i) <= chunk_size for i, _ in chunks)
+        return (np.concatenate([i for i, _ in chunks]),
+                np.concatenate([j for _, j in chunks]))
+
+    connector = {'probability': 1, 'n_connections': 1}
+    i, j = connections([dict(connector, condition='True')], 3, 4, 5)
+    assert_equal(i, np.repeat(np.arange(3), 4))
+    assert_equal(j, np.tile(np.arange(4), 3))
+    i, j = connections([dict(connector, condition='i == j')], 5, 3, 2)
+    assert_equal(i, [0, 1, 2])
+    assert_equal(j, [0, 1, 2])
+    i, j = connections([{'i': np.array([0, 1, 4]), 'j': 2}], 5, 3, 2)
+    assert_equal(i, [0, 1, 4])
+    assert_equal(j, [2, 2, 2])
+    with raises(NotImplementedError):
+        list(_connections([dict(connector, condition='True', probability=0.1)],
+                          3, 4))
+
+
+def test_synapses(tmp_path):
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    source = NeuronGroup(5, 'dv/dt = -v / (10*ms) : volt', threshold='v > 10*mV',
+                         reset='v = 0*mV', method='exact', name='source')
+    target = NeuronGroup(3, 'dv/dt = -v / (10*ms) : volt', method='exact',
+                         name='target')
+    w0 = 1*mV
+    synapses = Synapses(source, target[1:], 'w : volt',
+                        on_pre='w += w0', name='syn')
+    synapses.connect(i=[0, 1, 4], j=[1, 0, 1])
+    synapses.w = 0.5*mV
+    synapses.delay = 2*ms
+    run(10*ms)
+    exporter = NMLExporter()
+    exporter.create_lems_model(device.runs, recordingsname='recording')
+    model = exporter.model
+    synapse = [ct for ct in model.getElementsByTagName('ComponentType')
+               if ct.getAttribute('name') == 'syn'][0]
+    assert [p.getAttribute('name')
+            for p in synapse.getElementsByTagName('Parameter')] == ['w0', 'delay']
+    component = [c for c in model.getElementsByTagName('Component')
+                 if c.getAttribute('id') == 'synSyn'][0]
+    assert component.getAttribute('delay') == '2. ms'
+    on_event = synapse.getElementsByTagName('OnEvent')[0]
+    assert on_event.getAttribute('port') == 'in'
+    assert [(a.getAttribute('variable'), a.getAttribute('value'))
+            for a in on_event.getElementsByTagName('StateAssignment')] == \
+           [('w', 'w + w0')]
+    exporter.export_to_file(str(tmp_path / 'model'))
+    projection = [c for c in exporter.model.getElementsByTagName('Component')
+                  if c.getAttribute('id') == 'synProj'][0]
+    assert projection.getAttribute('presynapticPopulation') == 'sourceMultipop'
+    assert projection.getAttribute('postsynapticPopulation') == 'targetMultipop'
+    assert projection.getAttribute('synapse') == 'synSyn'
+    connection_file = tmp_path / projection.getAttribute('connectionFile')
+    assert connection_file.name == 'model_synProj.dat'
+    # indices of the subgroup are shifted to the full target population
+    assert_equal(np.loadtxt(connection_file, dtype=int),
+                 [[0, 2], [1, 1], [4, 2]])
+
+
+@mark.parametrize('kwds', [{'on_pre': 'v_post += w'},
+                                  {'on_pre': 'w += 1*mV', 'on_post': 'w -= 1*mV'},
+                                  {'on_pre': 'w += 1*mV', 'delay': 'i*ms'}])
+def test_synapses_not_supported(kwds):
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    group = NeuronGroup(2, 'v : volt', threshold='v > 10*mV', name='group')
+    delay = kwds.pop('delay', None)
+    synapses = Synapses(group, group, 'w : volt', name='syn', **kwds)
+    synapses.connect()
+    if delay is not None:
+        synapses.delay = delay
+    run(10*ms)
+    exporter = NMLExporter()
+    with raises(NotImplementedError):
+        exporter.create_lems_model(device.runs, recordingsname='recording')
+
+
+def test_synapses_summed_variable():
+    set_device('neuroml2', filename=LEMS_OUTPUT_FILENAME, build_on_run=False)
+    source = NeuronGroup(2, 'v : volt', threshold='v > 10*mV', name='source')
+    target = NeuronGroup(2, 'I_syn : amp', name='target')
+    synapses = Synapses(source, target, '''w : amp
+                                          I_syn_post = w : amp (summed)''',
+                        name='syn')
+    synapses.connect(j='i')
+    run(10*ms)
+    exporter = NMLExporter()
+    with catch_logs(only_from=('brian2tools', )) as logs:
+        exporter.create_lems_model(device.runs, recordingsname='recording')
+    assert any('summed variable' in log[2] for log in logs)
+    synapse = [ct for ct in exporter.model.getElementsByTagName('ComponentType')
+               if ct.getAttribute('name') == 'syn'][0]
+    assert [v.getAttribute('name')
+            for v in synapse.getElementsByTagName('StateVariable')] == ['w']
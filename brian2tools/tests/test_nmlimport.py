@@ -1,14 +1,25 @@
+import os
+import pickle
+import shutil
 from copy import deepcopy
 from os.path import abspath, dirname, join
 
+import numpy as np
+from neuroml import Include, Point3DWithDiam, Segment, SegmentParent
 from neuroml.loaders import NeuroMLLoader
+from brian2 import SpatialNeuron, DimensionMismatchError, set_device
 from brian2.units import *
 from numpy.testing import assert_equal, assert_allclose
-from pytest import raises
+from pytest import mark, raises
 
+import brian2tools.nmlimport.cache as nml_cache
+from brian2tools.nmlimport import (load_morphologies, load_cached_morphology,
+                                   load_morphology_streaming)
+from brian2tools.nmlimport.helper import get_parent_segment, get_child_segments
+import brian2tools.nmlimport.nml as nml
 from brian2tools.nmlimport.nml import NMLMorphology, validate_morphology, \
-    ValidationException
-from brian2tools.nmlutils.utils import string_to_quantity
+    ValidationException, clear_nml_doc_cache
+from brian2tools.nmlutils.utils import string_to_quantity, strings_to_quantity
 
 POINTS = ((0, 'soma', 0.0, 0.0, 0.0, 23.0, -1),
           (1, 'soma', 0.0, 17.0, 0.0, 23.0, 0),
@@ -71,6 +82,22 @@ def test_string_to_quantities():
                1.28 * kHz, -1.00000008e8, 0.07 / ms, 10 * psiemens]
     for t, r in zip(testlist, reslist):
         assert_equal(r, string_to_quantity(t))
+    assert_equal(string_to_quantity("2.84 uF_per_cm2"), 2.84 * ufarad / cm2)
+    assert_equal(string_to_quantity("3.0E-6 mol_per_cm3"), 3e-6 * mole / cm3)
+    assert_equal(string_to_quantity("1.5 m-2"), 1.5 * metre ** -2)
+    for wrong in ["mV", "1 xyz", "1 mS_per_cm2_per_s"]:
+        with raises(ValueError):
+            string_to_quantity(wrong)
+
+
+def test_strings_to_quantity():
+    values = strings_to_quantity(["1 mV", "-2.5mV", "1e2 mV"])
+    assert_equal(values, [1, -2.5, 100] * mV)
+    assert_equal(strings_to_quantity(["60", "-1.5"]), [60, -1.5])
+    assert_allclose(strings_to_quantity(["10 mS_per_cm2", "1 S_per_m2"]),
+                    [100, 1] * siemens / meter ** 2)
+    with raises(DimensionMismatchError):
+        strings_to_quantity(["1 mV", "1 ms"])
 
 
 def test_get_properties():
@@ -107,3 +134,333 @@ def test_channel_properties():
     assert channel_properties['soma_group']['E_Ca_pyr'] == 80. * mvolt
     assert channel_properties['soma_group']['g_Kahp_pyr'] == 25. * siemens / meter ** 2
     assert channel_properties['soma_group']['E_Kahp_pyr'] == -75. * mvolt
+
+
+def test_segment_indices():
+    nml_object = NMLMorphology(join(dirname(abspath(__file__)), SAMPLE))
+    segments = nml_object.segments
+    assert nml_object.seg_dict[5] is segments[5]
+    assert nml_object.root is segments[0]
+    # the parent can be looked up in the list or the dictionary of segments
+    assert get_parent_segment(segments[7], segments) is segments[6]
+    assert get_parent_segment(segments[7], nml_object.seg_dict) is segments[6]
+    assert nml_object._get_segment_group(nml_object.morph,
+                                         'basal_dends').id == 'basal_dends'
+    assert nml_object._get_segment_group(nml_object.morph, 'unknown') is None
+    assert_equal(sorted(nml_object.get_segment_group_ids('basal_dends',
+                                                         nml_object.morph)),
+                 [6, 7, 8])
+
+
+def test_segment_group_includes():
+    nml_object = NMLMorphology(join(dirname(abspath(__file__)), SAMPLE))
+    resolved = {}
+    assert_equal(nml_object.get_segment_group_ids('all', nml_object.morph,
+                                                  resolved),
+                 range(9))
+    # included groups are resolved only once
+    assert_equal(resolved['basal1'], [7])
+    assert resolved['all'] is nml_object.get_segment_group_ids(
+        'all', nml_object.morph, resolved)
+    morph = deepcopy(nml_object.morph)
+    soma = [g for g in morph.segment_groups if g.id == 'soma'][0]
+    soma.includes.append(Include(segment_groups='soma_group'))
+    with raises(ValueError, match='includes itself'):
+        nml_object.get_segment_group_ids('all', morph)
+
+
+def test_long_unbranched_morphology():
+    nml_object = NMLMorphology(join(dirname(abspath(__file__)), SAMPLE),
+                               name_heuristic=False)
+    # a soma with an axon that is much longer than the recursion limit
+    n = 5000
+    segments = [Segment(id=0, name='soma',
+                        proximal=Point3DWithDiam(x=0, y=0, z=0, diameter=10),
+                        distal=Point3DWithDiam(x=10, y=0, z=0, diameter=10))]
+    for idx in range(1, n):
+        segments.append(Segment(id=idx, name='axon',
+                                parent=SegmentParent(segments=idx - 1),
+                                distal=Point3DWithDiam(x=10 + idx, y=0, z=0,
+                                                       diameter=1)))
+    nml_object.seg_dict = nml_object._get_segment_dict(segments)
+    nml_object._adjust_morph_object(segments)
+    nml_object.children = get_child_segments(segments)
+    section = nml_object._create_tree(nml_object.SectionObject(), segments[0])
+    assert len(section.sectionList) == 1
+    assert len(section.sectionList[0].segmentList) == n - 1
+    morphology = nml_object.build_morphology(section)
+    assert morphology.total_compartments == n
+    axon = morphology[section.sectionList[0].name]
+    assert_allclose(axon.end_x, np.arange(11, n + 10) * um)
+    mapping = {}
+    assert nml_object._perform_dfs(mapping, 0, 0, nml_object.children) == n
+    assert mapping == {idx: idx for idx in range(n)}
+
+
+def test_nml_doc_cache(tmp_path, monkeypatch):
+    loaded, validated = [], []
+    load, validate = nml.loaders.NeuroMLLoader.load, nml.validate_neuroml2
+
+    def counting_load(file_path):
+        loaded.append(file_path)
+        return load(file_path)
+
+    def counting_validate(file_path):
+        validated.append(file_path)
+        return validate(file_path)
+
+    monkeypatch.setattr(nml.loaders.NeuroMLLoader, 'load', counting_load)
+    monkeypatch.setattr(nml, 'validate_neuroml2', counting_validate)
+    sample_dir = join(dirname(abspath(__file__)), 'samples')
+    for fname in os.listdir(sample_dir):
+        shutil.copy(join(sample_dir, fname), str(tmp_path))
+    filename = str(tmp_path / 'sample1.cell.nml')
+
+    clear_nml_doc_cache()
+    first = NMLMorphology(filename, validate=False)
+    assert len(loaded) == 7  # the cell and its six includes
+    assert validated == []
+    second = NMLMorphology(filename, validate=False)
+    assert len(loaded) == 7
+    # files are validated only once
+    NMLMorphology(filename)
+    assert len(validated) == 7
+    NMLMorphology(filename)
+    assert len(validated) == 7
+    # merging the includes does not change the cached documents
+    assert len(second.doc.ion_channel_hhs) == len(first.doc.ion_channel_hhs)
+    assert_equal(second.segment_groups['dendrite_group'],
+                 first.segment_groups['dendrite_group'])
+    # changes to a loaded document do not affect later loads
+    segments = first.doc.cells[0].morphology.segments
+    segments[1].distal.x += 100
+    segments[1].name = 'changed'
+    del segments[-1]
+    first.doc.cells[0].morphology.segment_groups[0].members.clear()
+    n_loaded = len(loaded)
+    third = NMLMorphology(filename, validate=False)
+    assert len(loaded) == n_loaded
+    assert str(third.morphology.topology()) == str(second.morphology.topology())
+    assert_allclose(third.morphology.end_x_, second.morphology.end_x_)
+    assert_equal(third.segment_groups['dendrite_group'],
+                 second.segment_groups['dendrite_group'])
+    assert third.doc.cells[0].morphology.segments[1].name != 'changed'
+
+    # modified files are parsed again
+    mtime = os.path.getmtime(filename)
+    os.utime(filename, (mtime + 10, mtime + 10))
+    n_loaded = len(loaded)
+    NMLMorphology(filename, validate=False)
+    assert loaded[n_loaded:] == [filename]
+    clear_nml_doc_cache()
+
+
+def test_describe():
+    nml_object = NMLMorphology(join(dirname(abspath(__file__)), SAMPLE))
+    description = pickle.loads(pickle.dumps(nml_object.describe()))
+    assert description._morphology is None
+    assert description.section_names[0] == nml_object.section.name
+    assert_equal(description.section_parents[:2], [-1, 0])
+    morphology = description.morphology
+    assert morphology is description.morphology
+    assert str(morphology.topology()) == str(nml_object.morphology.topology())
+    assert_allclose(morphology.end_x_, nml_object.morphology.end_x_)
+    assert_allclose(morphology.apical0.coordinates,
+                    nml_object.morphology.apical0.coordinates)
+    assert_allclose(morphology.basal0.basal1.diameter,
+                    nml_object.morphology.basal0.basal1.diameter)
+    assert description.properties == nml_object.properties
+    assert_equal(description.segment_groups['dendrite_group'],
+                 nml_object.segment_groups['dendrite_group'])
+
+
+@mark.parametrize('workers', [1, 2])
+def test_load_morphologies(tmp_path, workers):
+    filename = join(dirname(abspath(__file__)), SAMPLE)
+    broken = tmp_path / 'broken.nml'
+    broken.write_text('<neuroml>')
+    results = load_morphologies([filename, str(broken), filename],
+                                workers=workers, validate=False)
+    assert [r['filename'] for r in results] == [filename, str(broken),
+                                                filename]
+    for result in results[::2]:
+        assert result['error'] is None
+        assert result['time'] >= 0
+        assert_allclose(result['description'].morphology.length, [17.] * um)
+    assert results[1]['description'] is None
+    assert results[1]['error'] is not None
+
+
+def test_load_cached_morphology(tmp_path, monkeypatch):
+    sample_dir = join(dirname(abspath(__file__)), 'samples')
+    for fname in os.listdir(sample_dir):
+        shutil.copy(join(sample_dir, fname), str(tmp_path))
+    filename = str(tmp_path / 'sample1.cell.nml')
+    cache_dir = str(tmp_path / 'cache')
+    converted = load_cached_morphology(filename, cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+    def no_conversion(*args, **kwds):
+        raise AssertionError('morphology converted again')
+
+    with monkeypatch.context() as m:
+        m.setattr(nml_cache, 'NMLMorphology', no_conversion)
+        cached = load_cached_morphology(filename, cache_dir)
+        # the cache is also used by load_morphologies in worker processes
+        result, = load_morphologies([filename], workers=2,
+                                    cache_dir=cache_dir)
+    assert result['error'] is None
+    assert isinstance(cached.section_points[0], np.memmap)
+    for description in [cached, result['description']]:
+        assert description.section_names == converted.section_names
+        assert_equal(description.section_parents, converted.section_parents)
+        assert str(description.morphology.topology()) == \
+               str(converted.morphology.topology())
+        assert_allclose(description.morphology.basal0.basal2.coordinates,
+                        converted.morphology.basal0.basal2.coordinates)
+        assert description.properties == converted.properties
+        assert description.channel_properties == converted.channel_properties
+        assert_equal(description.segment_groups['dendrite_group'],
+                     converted.segment_groups['dendrite_group'])
+
+    # a modified file gets a new cache entry
+    with open(filename, 'a') as f:
+        f.write('\n')
+    load_cached_morphology(filename, cache_dir)
+    assert len(os.listdir(cache_dir)) == 4
+    # a different section naming gets a new cache entry
+    load_cached_morphology(filename, cache_dir, name_heuristic=False)
+    assert len(os.listdir(cache_dir)) == 6
+
+    # entries stored without validation are validated only once
+    with open(filename, 'a') as f:
+        f.write('\n')
+    load_cached_morphology(filename, cache_dir, validate=False)
+    validated = []
+    monkeypatch.setattr(nml_cache, 'validate_neuroml2', validated.append)
+    with monkeypatch.context() as m:
+        m.setattr(nml_cache, 'NMLMorphology', no_conversion)
+        load_cached_morphology(filename, cache_dir)
+        load_cached_morphology(filename, cache_dir)
+    assert validated == [os.path.abspath(filename)]
+
+
+def test_lazy_properties():
+    nml_object = NMLMorphology(join(dirname(abspath(__file__)), SAMPLE))
+    lazy = {'section', 'morphology', 'segment_groups', 'properties',
+            'channel_properties', 'ion_channels', 'Ri', 'Cm', 'threshold',
+            'threshold_string'}
+    assert not lazy & set(vars(nml_object))
+    nml_object.morphology
+    assert {'section', 'morphology'} <= set(vars(nml_object))
+    assert not {'properties', 'channel_properties',
+                'ion_channels'} & set(vars(nml_object))
+    assert sorted(nml_object.ion_channels) == ['Ca_pyr', 'Kahp_pyr', 'Kdr_pyr',
+                                               'LeakConductance_pyr', 'Na_pyr']
+    eqs = nml_object.get_channel_equations('Na_pyr')
+    assert nml_object.get_channel_equations('Na_pyr') is eqs
+    with raises(ValueError, match='Kdr_pyr'):
+        nml_object.get_channel_equations('unknown')
+    # the biophysical properties are also available as attributes
+    assert nml_object.Cm == {'all': 2.84 * uF / cm2}
+    assert nml_object.Ri == {'all': 0.2 * kohm * cm}
+    assert nml_object.threshold == 0 * mV
+    assert nml_object.properties['threshold'] == nml_object.threshold_string
+
+
+def test_set_channel_properties():
+    set_device('runtime')
+    nml_object = NMLMorphology(join(dirname(abspath(__file__)), SAMPLE))
+    channel_properties = nml_object.channel_properties
+    # channel parameters, plus a variable for segment group precedence
+    eqs = 'Im = 0*amp/meter**2 : amp/meter**2\n'
+    eqs += 'g_test : siemens/meter**2\n'
+    for values in channel_properties.values():
+        for name, value in values.items():
+            unit = 'volt' if name.startswith('E_') else 'siemens/meter**2'
+            eqs += '{} : {}\n'.format(name, unit)
+    neuron = SpatialNeuron(nml_object.morphology, eqs, method='euler')
+    reference = SpatialNeuron(nml_object.morphology, eqs, method='euler')
+    nml_object.set_channel_properties(neuron)
+    for segment_group, values in channel_properties.items():
+        indices = nml_object.segment_groups[segment_group]
+        for name, value in values.items():
+            getattr(reference, name)[indices] = value
+    for values in channel_properties.values():
+        for name in values:
+            assert_allclose(getattr(neuron, name)[:],
+                            getattr(reference, name)[:])
+    assert_allclose(neuron.g_Na_pyr[:], ([120] + [0] * 8) * msiemens / cm2)
+    # later segment groups take precedence
+    neuron.g_test = 1 * msiemens / cm2
+    nml_object.set_neuron_properties(neuron, 'g_test',
+                                     {'basal_dends': 2 * msiemens / cm2,
+                                      'middle_apical_dendrite': 3 * msiemens / cm2,
+                                      'basal_gaba_input': 4 * msiemens / cm2})
+    assert_allclose(neuron.g_test[:], [1, 1, 1, 3, 1, 1, 4, 2, 2] * msiemens / cm2)
+
+
+def _assert_same_description(description, reference):
+    assert description.section_names == reference.section_names
+    assert_equal(description.section_parents, reference.section_parents)
+    for points, reference_points in zip(description.section_points,
+                                        reference.section_points):
+        assert_allclose(points, reference_points)
+    assert sorted(description.segment_groups) == sorted(reference.segment_groups)
+    for group_id, indices in reference.segment_groups.items():
+        assert_equal(description.segment_groups[group_id], indices)
+    assert description.properties == reference.properties
+    assert description.channel_properties == reference.channel_properties
+
+
+@mark.parametrize('name_heuristic', [True, False])
+def test_load_morphology_streaming(name_heuristic):
+    filename = join(dirname(abspath(__file__)), SAMPLE)
+    reference = NMLMorphology(filename,
+                              name_heuristic=name_heuristic).describe()
+    description = load_morphology_streaming(filename,
+                                            name_heuristic=name_heuristic)
+    _assert_same_description(description, reference)
+    assert (str(description.morphology.topology()) ==
+            str(reference.morphology.topology()))
+
+
+def test_load_morphology_streaming_large(tmp_path):
+    # a branched cell with more segments than initially allocated, and
+    # segments without proximal points
+    n = 3000
+    lines = ['<neuroml xmlns="http://www.neuroml.org/schema/neuroml2" '
+             'id="large">',
+             '<cell id="large"><morphology id="morphology">',
+             '<segment id="0" name="soma">'
+             '<proximal x="0" y="0" z="0" diameter="20"/>'
+             '<distal x="0" y="20" z="0" diameter="20"/></segment>']
+    for idx in range(1, n):
+        parent = 0 if idx < 3 else idx - 2
+        lines.append('<segment id="{0}" name="dend{1}">'
+                     '<parent segment="{2}"/>'
+                     '<distal x="{1}" y="{0}" z="0" diameter="2"/>'
+                     '</segment>'.format(idx, idx % 2, parent))
+    lines += ['<segmentGroup id="odd">']
+    lines += ['<member segment="{}"/>'.format(idx) for idx in range(1, n, 2)]
+    lines += ['</segmentGroup>', '<segmentGroup id="all">',
+              '<member segment="0"/>', '<include segmentGroup="odd"/>',
+              '</segmentGroup>', '</morphology>',
+              '<biophysicalProperties id="biophys"><membraneProperties>',
+              '<spikeThresh value="0 mV"/>',
+              '<specificCapacitance value="1.0 uF_per_cm2"/>',
+              '<channelDensity id="leak" ionChannel="leak" '
+              'condDensity="0.3 mS_per_cm2" erev="-54.3mV" ion="non_specific"'
+              ' segmentGroup="odd"/>',
+              '</membraneProperties><intracellularProperties>',
+              '<resistivity value="0.1 kohm_cm"/>',
+              '</intracellularProperties></biophysicalProperties>',
+              '</cell></neuroml>']
+    filename = str(tmp_path / 'large.cell.nml')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines))
+    reference = NMLMorphology(filename, name_heuristic=False,
+                              validate=False).describe()
+    description = load_morphology_streaming(filename, name_heuristic=False)
+    _assert_same_description(description, reference)
+    assert description.morphology.total_compartments == n
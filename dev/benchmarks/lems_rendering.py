@@ -0,0 +1,57 @@
+'''
+Benchmark of the NeuroML2/LEMS export of a model with many near-identical
+neuron groups, with and without the expression cache of `LEMSRenderer`.
+
+Run with ``python lems_rendering.py [number of groups]``.
+'''
+import sys
+import timeit
+
+from brian2 import NeuronGroup, StateMonitor, Network, set_device, device, ms, mV
+from brian2.parsing.rendering import NodeRenderer
+
+from brian2tools.nmlexport.lemsexport import NMLExporter
+from brian2tools.nmlexport.lemsrendering import LEMSRenderer, _render_expr
+
+n_groups = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+set_device('neuroml2', filename='benchmark.xml', build_on_run=False)
+tau = 10*ms
+eqs = '''
+dv/dt = (v0 - v + w) / tau : volt (unless refractory)
+dw/dt = (-w + 0.5*(v - v0)) / (5*tau) : volt
+v0 : volt
+'''
+groups = []
+for idx in range(n_groups):
+    group = NeuronGroup(10, eqs, threshold='v > 10*mV and w < 5*mV',
+                        reset='v = 0*mV; w += 1*mV', refractory='v > 5*mV',
+                        method='euler', name='group{}'.format(idx))
+    group.v0 = '20*mV * i / (N-1)'
+    groups.append(group)
+monitor = StateMonitor(groups[0], 'v', record=True)
+net = Network(groups, monitor)
+net.run(10*ms)
+
+
+def export():
+    NMLExporter().create_lems_model(device.runs)
+
+
+def uncached_render_expr(self, expr, strip=True):
+    return NodeRenderer.render_expr(self, expr, strip)
+
+
+cached_render_expr = LEMSRenderer.render_expr
+repeats = 5
+LEMSRenderer.render_expr = uncached_render_expr
+uncached = min(timeit.repeat(export, number=1, repeat=repeats))
+LEMSRenderer.render_expr = cached_render_expr
+_render_expr.cache_clear()
+first_cached = timeit.timeit(export, number=1)
+cached = min(timeit.repeat(export, number=1, repeat=repeats))
+
+print('Export of {} groups'.format(n_groups))
+print('  without expression cache:     {:.3f}s'.format(uncached))
+print('  with empty expression cache:  {:.3f}s'.format(first_cached))
+print('  with filled expression cache: {:.3f}s'.format(cached))
@@ -0,0 +1,100 @@
+'''
+Benchmark of the import of large synthetic NeuroML morphologies with
+`NMLMorphology` and with the streaming `load_morphology_streaming`.
+
+The generated cell consists of a soma and a binary tree of unbranched
+dendrites with ``branch_length`` segments each. Apart from the first one,
+segments have no proximal point, so that it has to be taken from the parent
+segment. With a branch length at least as large as the number of segments,
+the cell is a soma with a single long axon.
+
+Run with ``python nml_import.py [number of segments] [number of groups]
+[branch length]``.
+'''
+import os
+import sys
+import tempfile
+import time
+
+from brian2tools.nmlimport.nml import NMLMorphology
+from brian2tools.nmlimport.streaming import load_morphology_streaming
+
+n_segments = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+n_groups = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+branch_length = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<neuroml xmlns="http://www.neuroml.org/schema/neuroml2" id="synthetic">
+  <cell id="synthetic">
+    <morphology id="morphology">
+      <segment id="0" name="soma">
+        <proximal x="0.0" y="0.0" z="0.0" diameter="20.0"/>
+        <distal x="0.0" y="20.0" z="0.0" diameter="20.0"/>
+      </segment>
+'''
+
+FOOTER = '''    </morphology>
+    <biophysicalProperties id="biophys">
+      <membraneProperties>
+        <spikeThresh value="0 mV"/>
+        <specificCapacitance value="1.0 uF_per_cm2"/>
+        <initMembPotential value="-65.0 mV"/>
+      </membraneProperties>
+      <intracellularProperties>
+        <resistivity value="0.1 kohm_cm"/>
+      </intracellularProperties>
+    </biophysicalProperties>
+  </cell>
+</neuroml>
+'''
+
+
+def write_morphology(f, n_segments, n_groups):
+    f.write(HEADER)
+    branch_ends = {0: 0}  # last segment of each branch
+    groups = [[] for _ in range(n_groups)]
+    seg_id = 1
+    branch = 1
+    while seg_id < n_segments:
+        parent = branch_ends[branch // 2]
+        for _ in range(min(branch_length, n_segments - seg_id)):
+            f.write('      <segment id="{0}" name="dend{1}">\n'
+                    '        <parent segment="{2}"/>\n'
+                    '        <distal x="{1}" y="{0}" z="0.0" diameter="2.0"/>\n'
+                    '      </segment>\n'.format(seg_id, branch, parent))
+            groups[branch % n_groups].append(seg_id)
+            parent = seg_id
+            seg_id += 1
+        branch_ends[branch] = parent
+        branch += 1
+    f.write('      <segmentGroup id="soma_group">\n'
+            '        <member segment="0"/>\n'
+            '      </segmentGroup>\n')
+    for idx, members in enumerate(groups):
+        f.write('      <segmentGroup id="group{}">\n'.format(idx))
+        f.writelines('        <member segment="{}"/>\n'.format(member)
+                     for member in members)
+        f.write('      </segmentGroup>\n')
+    f.write('      <segmentGroup id="all">\n'
+            '        <include segmentGroup="soma_group"/>\n')
+    f.writelines('        <include segmentGroup="group{}"/>\n'.format(idx)
+                 for idx in range(n_groups))
+    f.write('      </segmentGroup>\n')
+    f.write(FOOTER)
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    filename = os.path.join(tmpdir, 'synthetic.cell.nml')
+    with open(filename, 'w') as f:
+        write_morphology(f, n_segments, n_groups)
+    start = time.perf_counter()
+    morphology = NMLMorphology(filename, name_heuristic=False)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    description = load_morphology_streaming(filename, name_heuristic=False)
+    description.morphology
+    elapsed_streaming = time.perf_counter() - start
+
+print('Import of a morphology with {} segments and {} segment '
+      'groups: {:.2f}s'.format(n_segments, n_groups + 2, elapsed))
+print('Streaming import: {:.2f}s'.format(elapsed_streaming))